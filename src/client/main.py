@@ -15,7 +15,10 @@ import logging
 from random import randrange
 
 from shared import liburl_wrapper
-from shared.liburl_wrapper import safe_pushtx
+from shared.liburl_wrapper import safe_pushtx, safe_get_raw_transaction
+from shared.tx_cache import TransactionCache
+from shared.satoshi import Satoshi
+from shared.utxo_db import observed_prevtxs
 from shared.fastproto import (
     generateKey,
     sendMessage,
@@ -23,15 +26,16 @@ from shared.fastproto import (
     getMessages)
 
 from math import ceil
-from decimal import Decimal,getcontext
 
 START_COMMAND = "./runclient.sh"
 
-getcontext().prec = 8
-
 # if you'd like to use an external charter file, attach a value to the CHARTER_URL. Otherwise CHARTER_DATA will be used.
 CHARTER_URL = None
 
+# if an oracle runs on this machine, set this to its oracle.db (or pass it to main2)
+# and the deposit outputs are read from there instead of blockchain.info
+ORACLE_DB_FILE = None
+
 # A note on miners_fee:
 # Eligius requires 4096 satoshi fee per 512 bytes of transaction ( http://eligius.st/~gateway/faq-page )
 # With three oracles, the tx fee is around 512 bytes.
@@ -102,10 +106,10 @@ def main(args):
   print "number of nodes: %i" % len(charter['nodes'])
   print "required signatures: %i" % min_sigs
 
-  sum_fees_satoshi = 0
+  sum_fees_satoshi = Satoshi(0)
   for o in charter['nodes']:
-    sum_fees_satoshi += Decimal(o['fee'])*100000000
-  sum_fees_satoshi += Decimal(charter['org_fee'])*100000000
+    sum_fees_satoshi += Satoshi.from_btc(o['fee'])
+  sum_fees_satoshi += Satoshi.from_btc(charter['org_fee'])
 
 
 
@@ -136,13 +140,13 @@ def timelock(args):
   oracle_bms = []
   oracle_fastcasts = []
 
-  sum_fees_satoshi = Decimal(charter['org_fee']) * 100000000
+  sum_fees_satoshi = Satoshi.from_btc(charter['org_fee'])
 
   for o in charter['nodes']:
     oracle_pubkeys.append(o['pubkey'])
     oracle_fees[o['address']] = o['fee']
     oracle_fastcasts.append(o['fastcast'])
-    sum_fees_satoshi += Decimal(o['fee']) * 100000000
+    sum_fees_satoshi += Satoshi.from_btc(o['fee'])
   
   min_sigs = int(ceil(float(len(oracle_pubkeys))/2))
 
@@ -266,9 +270,32 @@ def timelock(args):
 
 
 
+def blockchain_prevtxs(msig_addr, redeemScript):
+  import requests
+  # for production purposes you might want to fetch the data using bitcoind, but that's expensive
+  address_json = requests.get("https://blockchain.info/address/%s?format=json" % msig_addr).text
+  address_history = json.loads(address_json)
+
+  prevtxs = []
+  sum_satoshi = 0
+
+  for tx in address_history['txs']:
+    for vout in tx['out']:
+      if vout['addr'] == msig_addr:
+        prevtx = {
+          'scriptPubKey' : vout['script'],
+          'vout': vout['n'],
+          'txid': tx['hash'],
+          'redeemScript': redeemScript,
+        }
+        sum_satoshi += vout['value']
+        prevtxs.append(prevtx)
+
+  return prevtxs, sum_satoshi
+
 def main2(args):
   if len(args)<3:
-    print "USAGE: `%s main2 <pubkey_once> <locktime_minutes> <return_address>`" % START_COMMAND
+    print "USAGE: `%s main2 <pubkey_once> <locktime_minutes> <return_address> [oracle_db_file]`" % START_COMMAND
     print "- run `%s main` to obtain pubkey_once" % START_COMMAND
     print "- keep in mind that this is alpha, don't expect oracles to run properly for any extended periods of time"
     print "- you don't want to lock money for over a week, and use anything above 0.05 BTC for testing"
@@ -280,6 +307,7 @@ def main2(args):
   client_pubkey = args[0]
   request['locktime'] = time.time() + int(args[1])*60
   request['return_address'] = args[2]
+  oracle_db_file = args[3] if len(args) > 3 else ORACLE_DB_FILE
 
   print "fetching charter url" # hopefully it didn't check between running main1 and main2
   charter = fetch_charter(CHARTER_URL)
@@ -310,40 +338,11 @@ def main2(args):
 
   print "fetching transactions incoming to %s ..." % msig_addr
 
-  import requests
-  # for production purposes you might want to fetch the data using bitcoind, but that's expensive
-  print "get"
-  address_json = requests.get("https://blockchain.info/address/%s?format=json" % msig_addr).text
-  #try:
-  print address_json
-  address_history = json.loads(address_json)
-  
-  #except:
-    #print "blockchain.info problem"
-    #print address_json
-    #return
-
-  prevtxs = []
-  sum_satoshi = 0
-
-  for tx in address_history['txs']:
-    outputs = []
-    if 'out' in tx:
-      outputs = outputs + tx['out']
-    if 'outputs' in tx:
-      outputs = outputs + tx['outputs']
-
-    for vout in tx['out']:
-      print vout
-      if vout['addr'] == msig_addr:
-        prevtx = {
-          'scriptPubKey' : vout['script'],
-          'vout': vout['n'],
-          'txid': tx['hash'],
-          'redeemScript': redeemScript,
-        }
-        sum_satoshi += vout['value']
-        prevtxs.append(prevtx)
+  prevtxs, sum_satoshi = observed_prevtxs(oracle_db_file, msig_addr, redeemScript)
+  if prevtxs:
+    print "found %i outputs in the local oracle database" % len(prevtxs)
+  else:
+    prevtxs, sum_satoshi = blockchain_prevtxs(msig_addr, redeemScript)
 
   if len(prevtxs) == 0:
     print "ERROR: couldn't find transactions sending money to %s" % msig_addr
@@ -405,6 +404,25 @@ def tx_info(args):
   pprint.pprint (btc.signatures(tx, prevtxs))
 
 
+def rawtx(args):
+  txid = args[0]
+  cache = TransactionCache()
+
+  raw_transaction = cache.get_raw(txid)
+  if not raw_transaction:
+    raw_transaction = safe_get_raw_transaction(txid)
+    if not raw_transaction:
+      print "couldn't fetch transaction %s" % txid
+      return
+    cache.put_raw(txid, raw_transaction)
+
+  print raw_transaction
+
+  decoded = cache.get_decoded(txid)
+  if decoded:
+    pprint.pprint(decoded)
+
+
 def pushtx(args):
   tx = args[0]
   print safe_pushtx(tx)
@@ -417,6 +435,7 @@ OPERATIONS = {
   'wait': wait_sign,
   'txinfo': tx_info,
   'pushtx': pushtx,
+  'rawtx': rawtx,
 }
 
 SHORT_DESCRIPTIONS = {
@@ -425,6 +444,7 @@ SHORT_DESCRIPTIONS = {
   'wait_sign': "waits for a signature",
   'tx_info': 'information about a signed tx',
   'pushtx': 'pushes tx to eligius',
+  'rawtx': 'raw transaction by txid, from the local cache or blockchain.info',
 }
 
 def help():
@@ -0,0 +1,143 @@
+from oracle_db import PendingBroadcast
+from shared.liburl_wrapper import fetcher
+from shared.bitcoind_client.bitcoinclient import TEST_MODE
+from shared.tx_cache import txid_for_raw
+
+import logging
+import threading
+import time
+import urllib
+import Queue
+
+PUSH_TIMEOUT = 60
+# how often pending broadcasts are checked if nothing new was enqueued
+BROADCAST_CHECK_TIME = 10
+# failed pushes are retried after 30s, 1min, 2min... up to an hour
+BROADCAST_RETRY_BASE_TIME = 30
+BROADCAST_RETRY_MAX_TIME = 60 * 60
+BROADCAST_MAX_ATTEMPTS = 50
+
+class HttpPushEndpoint:
+  """
+  Pushes the transaction by POSTing it as a form field. Push services answer
+  rejections with 200 error pages too, so the push counts only if the reply
+  contains accepted_marker -- the transaction's txid when not given
+  """
+  def __init__(self, name, url, field, extra_fields=None, accepted_marker=None):
+    self.name = name
+    self.url = url
+    self.field = field
+    self.extra_fields = extra_fields or {}
+    self.accepted_marker = accepted_marker
+
+  def push(self, tx):
+    query_args = dict(self.extra_fields)
+    query_args[self.field] = tx
+    content = fetcher.fetch(self.url, urllib.urlencode(query_args), timeout=PUSH_TIMEOUT)
+
+    marker = self.accepted_marker or txid_for_raw(tx)
+    if marker in content:
+      return True
+    logging.warning('%s did not accept the transaction: %r' % (self.name, content[:200]))
+    return False
+
+class BitcoindPushEndpoint:
+  """
+  Pushes the transaction with the node's sendrawtransaction
+  """
+  name = 'bitcoind'
+
+  def __init__(self, btc):
+    self.btc = btc
+
+  def push(self, tx):
+    # the node answers with the txid once it accepted tx, rejections raise
+    return bool(self.btc.blockchain_server.sendrawtransaction(tx))
+
+HTTP_PUSH_ENDPOINTS = [
+    HttpPushEndpoint('eligius', 'http://eligius.st/~wizkid057/newstats/pushtxn.php', 'transaction', {'send': 'Push'}),
+    HttpPushEndpoint('blockchain.info', 'https://blockchain.info/pushtx', 'tx', accepted_marker='Transaction Submitted'),
+]
+
+def push_endpoints(btc):
+  """
+  In TEST_MODE the local node isn't on the network the transactions are for,
+  so only the HTTP endpoints are used
+  """
+  endpoints = list(HTTP_PUSH_ENDPOINTS)
+  if not TEST_MODE:
+    endpoints.append(BitcoindPushEndpoint(btc))
+  return endpoints
+
+class TransactionBroadcaster:
+  """
+  Pushes signed transactions to all the endpoints in parallel, off the main loop.
+  A broadcast is done as soon as any endpoint accepts it, otherwise it's
+  retried with backoff.
+  """
+  def __init__(self, db, endpoints):
+    self.db = db
+    self.endpoints = endpoints
+    self.wakeup = threading.Event()
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name='broadcaster')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def enqueue(self, tx):
+    PendingBroadcast(self.db).save({'tx': tx, 'next_try': int(time.time())})
+    self.wakeup.set()
+
+  def run(self):
+    while True:
+      for pending in PendingBroadcast(self.db).get_due():
+        try:
+          self.broadcast(pending)
+        except:
+          logging.exception('problem broadcasting %r' % pending['id'])
+
+      self.wakeup.wait(BROADCAST_CHECK_TIME)
+      self.wakeup.clear()
+
+  def push_one(self, endpoint, tx, results):
+    success = False
+    try:
+      success = endpoint.push(tx)
+    except:
+      logging.warning('pushing tx to %s failed' % endpoint.name)
+    results.put((endpoint.name, success))
+
+  def push_all(self, tx):
+    """
+    Returns True on the first endpoint that accepts tx; the others finish in the background
+    """
+    results = Queue.Queue()
+    for endpoint in self.endpoints:
+      thread = threading.Thread(target=self.push_one, args=(endpoint, tx, results))
+      thread.daemon = True
+      thread.start()
+
+    for _ in self.endpoints:
+      name, success = results.get()
+      if success:
+        logging.info('tx pushed to %s' % name)
+        return True
+    return False
+
+  def broadcast(self, pending):
+    pending_broadcast = PendingBroadcast(self.db)
+
+    if self.push_all(pending['tx']):
+      pending_broadcast.done(pending)
+      return
+
+    attempts = pending['attempts'] + 1
+    if attempts >= BROADCAST_MAX_ATTEMPTS:
+      logging.error('giving up broadcasting %r' % pending['id'])
+      pending_broadcast.done(pending, PendingBroadcast.GAVE_UP)
+      return
+
+    delay = min(BROADCAST_RETRY_BASE_TIME * 2 ** (attempts - 1), BROADCAST_RETRY_MAX_TIME)
+    pending_broadcast.retry(pending, int(time.time()) + delay)
@@ -4,15 +4,14 @@ import hashlib
 
 import logging
 
-from decimal import Decimal, getcontext
-
-SATOSHI = 0.00000001
+from shared.bitcoind_client.rawtransaction import build_raw_transaction
+from shared.bitcoind_client.script import script_to_p2sh_address
+from shared.satoshi import Satoshi
 
 class BaseHandler:
   def __init__(self, oracle):
     self.oracle = oracle
     self.btc = oracle.btc
-    getcontext().prec=8
 
   def handle_request(self, request):
     raise NotImplementedError()
@@ -29,9 +28,40 @@ class BaseHandler:
   def handle_new_transactions(self, transactions):
     pass
 
+  def handle_pending_transactions(self, transactions):
+    """
+    Called with not yet confirmed transactions on observed addresses,
+    they come once more through handle_new_transactions when confirmed
+    """
+    pass
+
+  def transaction_jobs(self, transactions, pending=False):
+    """
+    Work for transactions on observed addresses as (key, function, args) jobs
+    for the worker pool, keyed like the tasks of the contracts they touch
+    """
+    if pending:
+      return [(self.__class__.__name__, self.handle_pending_transactions, (transactions, ))]
+    return [(self.__class__.__name__, self.handle_new_transactions, (transactions, ))]
+
   def valid_task(self, task):
   	return True
 
+  @classmethod
+  def request_key(cls, message):
+    """
+    Returns the key of the contract the request refers to. Work with the same
+    key is handled in order, work with different keys may run concurrently
+    """
+    return message['operation']
+
+  @classmethod
+  def task_key(cls, task):
+    """
+    Same as request_key, but for tasks
+    """
+    return task['operation']
+
   def get_tx_hash(self, tx):
     inputs, outputs = self.btc.get_inputs_outputs(tx)
     request_dict= {
@@ -47,12 +77,12 @@ class BaseHandler:
       if not 'redeemScript' in prevtx:
         return False
       script = prevtx['redeemScript']
-      address = self.btc.decode_script(script)['p2sh']
+      address = script_to_p2sh_address(script)
       addresses.add(address)
     return list(addresses)
 
   def try_prepare_raw_transaction_full_node(self, message):
-    value = message['value']
+    value = Satoshi.from_btc(message['value'])
     return_address = message['return_address']
     txid = message['txid']
     n = message['n']
@@ -60,10 +90,11 @@ class BaseHandler:
 
     outputs = {}
 
-    left_cash = value - (SATOSHI * message['miners_fee_satoshi'])
+    left_cash = value - message['miners_fee_satoshi']
 
     has_my_fee = False
     for oracle, fee in oracle_fees.iteritems():
+      fee = Satoshi.from_btc(fee)
       outputs[oracle] = fee
       left_cash -= fee
 
@@ -79,9 +110,9 @@ class BaseHandler:
       return None
 
     outputs[return_address] = left_cash
-    inputs = [(txid, n)]
+    inputs = [{'txid': txid, 'vout': n}]
 
-    transaction = self.btc.create_raw_transaction(inputs, outputs)
+    transaction = build_raw_transaction(inputs, outputs)
     return transaction
 
   def try_prepare_raw_transaction(self, message):
@@ -96,7 +127,7 @@ class BaseHandler:
       logging.debug("all inputs should come from the same multisig address")
       return False
 
-    cash_back = Decimal(Decimal(SATOSHI) * (message['sum_satoshi'] - message['miners_fee_satoshi']))
+    cash_back = Satoshi(message['sum_satoshi'] - message['miners_fee_satoshi'])
 
     logging.debug(cash_back)
 
@@ -104,8 +135,9 @@ class BaseHandler:
 
     has_my_fee = False
     for oracle, fee in message['outputs'].iteritems(): #outputs.iteritems():
+      fee = Satoshi.from_btc(fee)
       outputs[oracle] = fee
-      cash_back -= Decimal(fee)
+      cash_back -= fee
 
       if self.oracle.is_fee_sufficient(oracle, fee):
         has_my_fee = True
@@ -118,17 +150,9 @@ class BaseHandler:
       logging.debug("BTC amount not high enough to cover expenses")
       return None
 
-    outputs[ message['return_address'] ] = float(cash_back)
-
-    logging.debug("outputs2: %r" % outputs)
-
-    for address in outputs:
-      # My heart bleeds when I write it
-      # but btc expects float as input for the currency amount
-      outputs[address] = float(outputs[address])
-
+    outputs[ message['return_address'] ] = cash_back
 
     logging.debug(outputs)
 
-    transaction = self.btc.create_raw_transaction(inputs, outputs)
+    transaction = build_raw_transaction(inputs, outputs)
     return transaction
@@ -3,15 +3,12 @@
 
 from basehandler import BaseHandler
 from password_db import LockedPasswordTransaction, RSAKeyPairs
+from util import Util
 
 import hashlib
 import json
 import logging
 
-from Crypto.PublicKey import RSA
-from Crypto import Random
-
-KEY_SIZE = 4096
 HEURISTIC_ADD_TIME = 60 * 3
 
 # 15 minutes just to be sure no one claimed it
@@ -30,22 +27,23 @@ class BountyCreateHandler(BaseHandler):
     if key:
       return key['public']
 
-    random_generator = Random.new().read
-    new_keypair = RSA.generate(KEY_SIZE, random_generator)
-    public_key = json.dumps({'n':new_keypair.n, 'e':new_keypair.e})
-    whole_key_serialized = json.dumps({
-        'n':new_keypair.n,
-        'e':new_keypair.e,
-        'd':new_keypair.d,
-        'p':new_keypair.p,
-        'q':new_keypair.q,
-        'u':new_keypair.u})
+    key = RSAKeyPairs(self.oracle.db).claim(pwtxid)
+    if key:
+      return key['public']
+
+    # should happen only if bounties come faster than KeypairPool generates keys
+    logging.warning('rsa keypair pool is empty, generating a new key')
+    public_key, whole_key_serialized = Util.generate_keypair()
     RSAKeyPairs(self.oracle.db).save({
         'pwtxid': pwtxid,
         'public': public_key,
         'whole': whole_key_serialized})
     return public_key
 
+  @classmethod
+  def task_key(cls, task):
+    return json.loads(task['json_data'])['pwtxid']
+
   def handle_request(self, request):
     message = request.message
 
@@ -66,7 +64,10 @@ class BountyCreateHandler(BaseHandler):
 
     locktime = int(message['locktime'])
 
-    LockedPasswordTransaction(self.oracle.db).save({'pwtxid':pwtxid, 'json_data':json.dumps(message)})
+    LockedPasswordTransaction(self.oracle.db).save({
+        'pwtxid': pwtxid,
+        'json_data': json.dumps(message),
+        'password_hash': message['password_hash']})
 
     logging.debug('broadcasting reply')
 
@@ -8,6 +8,8 @@ from password_db import (
     RightGuess,
     SentPasswordTransaction)
 from util import Util
+from guess_decryptor import decrypt_guess
+from guess_guard import guess_guard
 
 import base64
 import hashlib
@@ -15,7 +17,7 @@ import json
 import logging
 import time
 
-from decimal import Decimal
+from shared.satoshi import Satoshi
 
 WAIT_TIME = 5 # seconds delay before checking responses
 
@@ -27,17 +29,17 @@ class GuessPasswordHandler(BaseHandler):
 
   def decrypt_message(self, pwtxid, base64_msg):
     msg = base64.decodestring(base64_msg)
-    rsa_key = Util.construct_key_from_data(
-        RSAKeyPairs(self.oracle.db).get_by_pwtxid(pwtxid))
-    message = rsa_key.decrypt(msg)
-    return message
-
-  def guess_is_right(self, pwtxid, guess):
-    message = self.decrypt_message(pwtxid, guess)
+    rsa_data = RSAKeyPairs(self.oracle.db).get_by_pwtxid(pwtxid)
+    message = decrypt_guess(pwtxid, rsa_data, msg)
     try:
-      message = json.loads(message)
+      return json.loads(message)
     except ValueError:
       logging.debug('problem decoding the message')
+      return None
+
+  def guess_is_right(self, pwtxid, message):
+    # message is the already decrypted guess
+    if not isinstance(message, dict):
       return False
 
     logging.debug("message: %r" % message)
@@ -47,24 +49,37 @@ class GuessPasswordHandler(BaseHandler):
 
     pass_hash = hashlib.sha512(message['password']).hexdigest()
 
-    transaction = LockedPasswordTransaction(self.oracle.db).get_by_pwtxid(pwtxid)
-    details = json.loads(transaction['json_data'])
+    original_hash = LockedPasswordTransaction(self.oracle.db).get_password_hash(pwtxid)
+    if not original_hash:
+      return False
 
     logging.debug("password hash %r..." % pass_hash[0:20])
-    logging.debug("original hash %r..." % details['password_hash'][0:20])
+    logging.debug("original hash %r..." % original_hash[0:20])
 
-    return pass_hash == details['password_hash']
+    return pass_hash == original_hash
 
   def get_address(self, pwtxid, guess):
-    # Assumes guess_is_right was already called and all the data is correct
+    # Only for tasks created before the address was stored with the task
     message = self.decrypt_message(pwtxid, guess)
-    message = json.loads(message)
     return message['address']
 
+  @classmethod
+  def request_key(cls, message):
+    return message['pwtxid']
+
+  @classmethod
+  def task_key(cls, task):
+    return json.loads(task['json_data'])['pwtxid']
+
   def handle_request(self, request):
     message = request.message
 
     pwtxid = message['pwtxid']
+
+    if not guess_guard.allow_source(request.from_address):
+      logging.info('too many guesses from %r, ignoring' % request.from_address)
+      return
+
     rsa_key = RSAKeyPairs(self.oracle.db).get_by_pwtxid(pwtxid)
 
     logging.info('attemting to decode %r' % pwtxid)
@@ -90,7 +105,13 @@ class GuessPasswordHandler(BaseHandler):
 
     guess = message['passwords'][rsa_hash]
 
-    if self.guess_is_right(pwtxid, guess):
+    if guess_guard.was_rejected(pwtxid, guess):
+      logging.debug('guess already rejected')
+      return
+
+    decrypted = self.decrypt_message(pwtxid, guess)
+
+    if self.guess_is_right(pwtxid, decrypted):
       logging.debug('guess correct')
 
       # Create RightGuess, create task
@@ -98,6 +119,7 @@ class GuessPasswordHandler(BaseHandler):
       guess_dict = {
           'pwtxid': pwtxid,
           'guess': guess,
+          'address': decrypted['address'],
           'received_time': guess_time
       }
       RightGuess(self.oracle.db).save(guess_dict)
@@ -108,11 +130,15 @@ class GuessPasswordHandler(BaseHandler):
           'json_data': json.dumps(guess_dict)})
     else:
       logging.debug('guess incorrect!')
+      guess_guard.reject(pwtxid, guess)
 
   def handle_task(self, task):
     data = json.loads(task['json_data'])
     pwtxid = data['pwtxid']
-    address = self.get_address(pwtxid, data['guess'])
+    if 'address' in data:
+      address = data['address']
+    else:
+      address = self.get_address(pwtxid, data['guess'])
     transaction = LockedPasswordTransaction(self.oracle.db).get_by_pwtxid(pwtxid)
     if not transaction:
       logging.error('txid not found!')
@@ -120,6 +146,7 @@ class GuessPasswordHandler(BaseHandler):
       return
 
     LockedPasswordTransaction(self.oracle.db).mark_as_done(pwtxid)
+    guess_guard.forget(pwtxid)
     if transaction['done'] == 1:
       logging.info('someone was faster')
       self.oracle.task_queue.done(task)
@@ -129,11 +156,10 @@ class GuessPasswordHandler(BaseHandler):
     prevtx = message['prevtx']
     locktime = message['locktime']
     outputs = message['oracle_fees']
-    sum_amount = Decimal(message['sum_amount'])
-    miners_fee = Decimal(message['miners_fee'])
+    sum_amount = Satoshi.from_btc(message['sum_amount'])
+    miners_fee = Satoshi.from_btc(message['miners_fee'])
     available_amount = sum_amount - miners_fee
     future_transaction = Util.create_future_transaction(
-        self.oracle.btc,
         prevtx,
         outputs,
         available_amount,
@@ -0,0 +1,47 @@
+from util import Util
+
+import logging
+import multiprocessing
+import threading
+
+DECRYPT_POOL_SIZE = 2
+# how many rebuilt keys every decrypting process keeps
+KEY_CACHE_SIZE = 100
+
+# pwtxid -> RSA key; lives inside the decrypting processes
+key_cache = {}
+
+def decrypt(pwtxid, rsa_data, ciphertext):
+  key = key_cache.get(pwtxid)
+  if key is None:
+    if len(key_cache) >= KEY_CACHE_SIZE:
+      key_cache.clear()
+    key = Util.construct_key_from_data(rsa_data)
+    key_cache[pwtxid] = key
+  return key.decrypt(ciphertext)
+
+pool = None
+pool_lock = threading.Lock()
+
+def start_pool():
+  """
+  The processes are forked, so it has to be called before any threads
+  or database connections exist
+  """
+  global pool
+  with pool_lock:
+    if pool is None:
+      pool = multiprocessing.Pool(DECRYPT_POOL_SIZE)
+    return pool
+
+def get_pool():
+  if pool is None:
+    logging.warning('decrypt pool was not started at startup, forking it now')
+  return start_pool()
+
+def decrypt_guess(pwtxid, rsa_data, ciphertext):
+  """
+  4096-bit RSA decryption is CPU heavy, so it runs in a separate process
+  pool instead of the oracle threads. Blocks until the result is ready.
+  """
+  return get_pool().apply(decrypt, (pwtxid, {'whole': rsa_data['whole']}, ciphertext))
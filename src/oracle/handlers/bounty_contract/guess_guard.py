@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from shared.ratelimit import TokenBucket
+
+import hashlib
+import threading
+import time
+
+# every Fastcast source can send a guess every 10 seconds, with bursts of 5
+GUESS_RATE = 0.1
+GUESS_BURST = 5
+MAX_TRACKED_SOURCES = 10000
+
+# rejected guesses are remembered for an hour, up to 1000 per bounty
+REJECTED_TIME = 60 * 60
+REJECTED_PER_PWTXID = 1000
+
+class GuessGuard:
+  """
+  Keeps abusive guessing cheap: throttles guesses per Fastcast source
+  and remembers ciphertexts that were already rejected, so they are never
+  decrypted twice
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.buckets = OrderedDict()
+    self.rejected = {}
+
+  def allow_source(self, source):
+    with self.lock:
+      bucket = self.buckets.pop(source, None)
+      if bucket is None:
+        bucket = TokenBucket(GUESS_RATE, GUESS_BURST)
+        if len(self.buckets) >= MAX_TRACKED_SOURCES:
+          self.buckets.popitem(last=False)
+      self.buckets[source] = bucket
+    return bucket.consume()
+
+  def guess_hash(self, guess):
+    return hashlib.sha256(guess).hexdigest()
+
+  def was_rejected(self, pwtxid, guess):
+    with self.lock:
+      rejected = self.rejected.get(pwtxid)
+      if not rejected:
+        return False
+      guess_hash = self.guess_hash(guess)
+      if not guess_hash in rejected:
+        return False
+      if rejected[guess_hash] < time.time():
+        del rejected[guess_hash]
+        return False
+      return True
+
+  def reject(self, pwtxid, guess):
+    with self.lock:
+      rejected = self.rejected.setdefault(pwtxid, OrderedDict())
+      guess_hash = self.guess_hash(guess)
+      rejected.pop(guess_hash, None)
+      if len(rejected) >= REJECTED_PER_PWTXID:
+        rejected.popitem(last=False)
+      rejected[guess_hash] = time.time() + REJECTED_TIME
+
+  def forget(self, pwtxid):
+    with self.lock:
+      self.rejected.pop(pwtxid, None)
+
+# handlers are created for every request, so the state is shared here
+guess_guard = GuessGuard()
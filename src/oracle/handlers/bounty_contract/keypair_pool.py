@@ -0,0 +1,70 @@
+from oracle.oracle_db import OracleDb
+from password_db import RSAKeyPairs
+from util import Util
+
+import logging
+import multiprocessing
+import threading
+import time
+
+# number of ready keypairs we keep for new bounties
+KEYPAIR_POOL_SIZE = 10
+POOL_CHECK_TIME = 10
+
+def reset_logging_locks():
+  # a restart forks from the running oracle, where another thread may have
+  # held a logging lock at that moment
+  logging._lock = threading.RLock()
+  for handler in logging.getLogger().handlers:
+    handler.createLock()
+
+def fill_pool(size):
+  reset_logging_locks()
+  # runs in a separate process, so it needs its own connection
+  keypairs = RSAKeyPairs(OracleDb())
+
+  while True:
+    try:
+      if keypairs.available_count() >= size:
+        time.sleep(POOL_CHECK_TIME)
+        continue
+
+      public_key, whole_key_serialized = Util.generate_keypair()
+      keypairs.save({
+          'pwtxid': None,
+          'public': public_key,
+          'whole': whole_key_serialized})
+    except Exception:
+      # e.g. database is locked; bounties would fall back to inline keys
+      logging.exception('keypair pool failed to add a key')
+      time.sleep(POOL_CHECK_TIME)
+
+class KeypairPool:
+  """
+  Generating a 4096-bit RSA key takes seconds of CPU, so the keys for bounties
+  are generated in advance by a background process. It's forked, so it has
+  to be started before any threads or database connections exist.
+  """
+  def __init__(self, size=KEYPAIR_POOL_SIZE, target=fill_pool):
+    self.size = size
+    self.target = target
+    self.process = None
+
+  def start(self):
+    self.process = multiprocessing.Process(target=self.target, args=(self.size, ), name='keypair-pool')
+    self.process.daemon = True
+    self.process.start()
+    logging.info('keypair pool started, keeping %r keys ready' % self.size)
+
+  def ensure_running(self):
+    """
+    Restarts the process if it died, returns False when it had to
+    """
+    if self.process is None or self.process.is_alive():
+      return True
+    logging.error('keypair pool process exited with %r, restarting it' % self.process.exitcode)
+    self.start()
+    return False
+
+  def available(self, db):
+    return RSAKeyPairs(db).available_count()
@@ -1,9 +1,30 @@
 import json
 
 from Crypto.PublicKey import RSA
-from decimal import Decimal
+from Crypto import Random
+from shared.bitcoind_client.rawtransaction import build_raw_transaction
+from shared.satoshi import Satoshi
+
+KEY_SIZE = 4096
 
 class Util:
+  @staticmethod
+  def generate_keypair(key_size=KEY_SIZE):
+    """
+    Returns serialized (public, whole) RSA keypair, as stored in RSAKeyPairs
+    """
+    random_generator = Random.new().read
+    new_keypair = RSA.generate(key_size, random_generator)
+    public_key = json.dumps({'n':new_keypair.n, 'e':new_keypair.e})
+    whole_key_serialized = json.dumps({
+        'n':new_keypair.n,
+        'e':new_keypair.e,
+        'd':new_keypair.d,
+        'p':new_keypair.p,
+        'q':new_keypair.q,
+        'u':new_keypair.u})
+    return public_key, whole_key_serialized
+
   @staticmethod
   def construct_key_from_data(rsa_data):
     k = json.loads(rsa_data['whole'])
@@ -24,20 +45,19 @@ class Util:
     return key
 
   @staticmethod
-  def create_future_transaction(btc, prevtx, outputs, amount_available, receiver_address, locktime):
+  def create_future_transaction(prevtx, outputs, amount_available, receiver_address, locktime):
+    # outputs are oracle fees in BTC, amount_available is in satoshi
     inputs = []
     for tx in prevtx:
       inputs.append({'txid': tx['txid'], 'vout': tx['vout']})
-    cash_back = amount_available
-    for oracle, fee in outputs.iteritems():
-      cash_back -= Decimal(fee)
-
-    outputs[receiver_address] = cash_back
+    cash_back = Satoshi(amount_available)
 
     vout = {}
-    for address, value in outputs.iteritems():
-      # My heart bleeds when I write it
-      vout[address] = float(value)
+    for oracle, fee in outputs.iteritems():
+      vout[oracle] = Satoshi.from_btc(fee)
+      cash_back -= vout[oracle]
+
+    vout[receiver_address] = cash_back
 
-    transaction = btc.create_raw_transaction(inputs, vout)
+    transaction = build_raw_transaction(inputs, vout)
     return transaction
@@ -1,5 +1,7 @@
 from shared.db_classes import TableDb
 
+import json
+
 class LockedPasswordTransaction(TableDb):
   """
   Database entry will keep locked password transaction, anyone can try to unlock it,
@@ -11,28 +13,39 @@ class LockedPasswordTransaction(TableDb):
       ts datetime default current_timestamp, \
       pwtxid text unique, \
       json_data text not null, \
-      done integer default 0)'
-  insert_sql = 'insert into {0} (pwtxid, json_data) values (?, ?)'
-  all_sql = 'select * from {0} order by ts'
+      done integer default 0, \
+      password_hash text)'
+  extra_columns = [('password_hash', 'text')]
+  indexes = ['password_hash']
+  insert_sql = 'insert into {0} (pwtxid, json_data, password_hash) values (?, ?, ?)'
   pwtxid_sql = 'select * from {0} where pwtxid=?'
   mark_done_sql = 'update {0} set done=1 where pwtxid=?'
+  password_hash_sql = 'select password_hash, json_data from {0} where pwtxid=?'
+  set_password_hash_sql = 'update {0} set password_hash=? where pwtxid=?'
 
   def mark_as_done(self, pwtxid):
-    cursor = self.db.get_cursor()
     sql = self.mark_done_sql.format(self.table_name)
-
-    cursor.execute(sql, (pwtxid,))
+    self.execute_sql_properly(sql, (pwtxid,))
 
   def args_for_obj(self, obj):
-    return [obj['pwtxid'], obj['json_data']]
+    return [obj['pwtxid'], obj['json_data'], obj.get('password_hash')]
 
-  def get_all(self):
+  def get_password_hash(self, pwtxid):
     cursor = self.db.get_cursor()
-    sql = self.all_sql.format(self.table_name)
+    sql = self.password_hash_sql.format(self.table_name)
 
-    rows = cursor.execute(sql).fetchall()
-    rows = [dict(row) for row in rows]
-    return rows
+    row = cursor.execute(sql, (pwtxid, )).fetchone()
+    if not row:
+      return None
+    if row['password_hash']:
+      return row['password_hash']
+
+    # bounties saved before the column existed keep the hash in json only
+    password_hash = json.loads(row['json_data']).get('password_hash')
+    if password_hash:
+      sql = self.set_password_hash_sql.format(self.table_name)
+      self.execute_sql_properly(sql, (password_hash, pwtxid))
+    return password_hash
 
   def get_by_pwtxid(self, pwtxid):
     cursor = self.db.get_cursor()
@@ -44,6 +57,10 @@ class LockedPasswordTransaction(TableDb):
     return None
 
 class RSAKeyPairs(TableDb):
+  """
+  Keypairs with pwtxid set to null are pre-generated by KeypairPool
+  and wait to be claimed by a new bounty
+  """
   table_name = 'rsa_keypairs'
   create_sql = 'create table {0} ( \
       id integer primary key autoincrement, \
@@ -52,19 +69,26 @@ class RSAKeyPairs(TableDb):
       public text not null, \
       whole text not null)'
   insert_sql = 'insert into {0} (pwtxid, public, whole) values (?, ?, ?)'
-  all_sql = 'select * from {0} order by ts'
   pwtxid_sql = 'select * from {0} where pwtxid=?'
+  claim_sql = 'update {0} set pwtxid=? where id=(select id from {0} where pwtxid is null order by id limit 1)'
+  available_sql = 'select count(*) from {0} where pwtxid is null'
 
   def args_for_obj(self, obj):
     return [obj['pwtxid'], obj['public'], obj['whole']]
 
-  def get_all(self):
+  def claim(self, pwtxid):
+    """
+    Assigns a pre-generated keypair to pwtxid. Returns None if there are none left
+    """
+    sql = self.claim_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (pwtxid, ))
+    return self.get_by_pwtxid(pwtxid)
+
+  def available_count(self):
     cursor = self.db.get_cursor()
-    sql = self.all_sql.format(self.table_name)
+    sql = self.available_sql.format(self.table_name)
 
-    rows = cursor.execute(sql).fetchall()
-    rows = [dict(row) for row in rows]
-    return rows
+    return cursor.execute(sql).fetchone()[0]
 
   def get_by_pwtxid(self, pwtxid):
     cursor = self.db.get_cursor()
@@ -85,20 +109,11 @@ class RightGuess(TableDb):
       guess text not null, \
       received_time integer not null)'
   insert_sql = 'insert into {0} (pwtxid, guess, received_time) values (?, ?, ?)'
-  all_sql = 'select * from {0} order by ts'
   pwtxid_sql = 'select * from {0} where pwtxid=?'
 
   def args_for_obj(self, obj):
     return [obj['pwtxid'], obj['guess'], obj['received_time']]
 
-  def get_all(self):
-    cursor = self.db.get_cursor()
-    sql = self.all_sql.format(self.table_name)
-
-    rows = cursor.execute(sql).fetchall()
-    rows = [dict(row) for row in rows]
-    return rows
-
   def get_by_pwtxid(self, pwtxid):
     cursor = self.db.get_cursor()
     sql = self.pwtxid_sql.format(self.table_name)
@@ -117,21 +132,12 @@ class SentPasswordTransaction(TableDb):
       rqhs text not null, \
       tx text not null)'
   insert_sql = 'insert into {0} (pwtxid, rqhs, tx) values (?, ?, ?)'
-  all_sql = 'select * from {0} order by ts'
   pwtxid_sql = 'select * from {0} where pwtxid=?'
   rqhs_sql = 'select * from {0} where rqhs=?'
 
   def args_for_obj(self, obj):
     return [obj['pwtxid'], obj['rqhs'], obj['tx']]
 
-  def get_all(self):
-    cursor = self.db.get_cursor()
-    sql = self.all_sql.format(self.table_name)
-
-    rows = cursor.execute(sql).fetchall()
-    rows = [dict(row) for row in rows]
-    return rows
-
   def get_by_pwtxid(self, pwtxid):
     cursor = self.db.get_cursor()
     sql = self.pwtxid_sql.format(self.table_name)
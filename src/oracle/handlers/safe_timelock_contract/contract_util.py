@@ -1,6 +1,8 @@
 
 import hashlib
 
+from shared.satoshi import Satoshi
+
 def get_mark_for_address(address):
   address_hash = hashlib.sha512(address).hexdigest()
 
@@ -8,5 +10,9 @@ def get_mark_for_address(address):
   as_mark = as_number % 10000
   return as_mark
 
+def contract_key(address, mark):
+  # contract_id of a safe timelock, also the worker pool key of its work
+  return '{}#{}'.format(address, mark)
+
 def value_to_mark(value):
-  return int(round(value * 100000000)) % 10000
+  return int(Satoshi.from_btc(value) % 10000)
@@ -6,9 +6,11 @@ import logging
 import time
 import datetime
 
-from contract_util import get_mark_for_address
-from oracle.oracle_db import KeyValue
+from contract_util import get_mark_for_address, contract_key
+from oracle.oracle_db import KeyValue, ObservedUtxo
+from shared.bitcoind_client.script import multisig_redeem_script, script_to_p2sh_address
 from random import randrange
+from shared.satoshi import Satoshi
 
 TIME_FOR_TRANSACTION = 30 * 60
 TIME_FOR_CONFIRMATION = 20 * 60
@@ -45,18 +47,20 @@ class SafeTimelockCreateHandler(BaseHandler):
     logging.info("claimed mark {} for addr {}".format(mark, return_address))
 
   def extend_observed_addresses(self, address):
-    observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
-    if not observed_addresses:
-      self.kv.store('safe_timelock', 'addresses', {'addresses':[]})
+    # the list is shared by all the contracts
+    with self.oracle.db.write_lock:
+      observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
+      if not observed_addresses:
+        self.kv.store('safe_timelock', 'addresses', {'addresses':[]})
 
-    observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
-    observed_addresses = observed_addresses['addresses']
-    if address in observed_addresses:
-      return
+      observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
+      observed_addresses = observed_addresses['addresses']
+      if address in observed_addresses:
+        return
 
-    observed_addresses.append(address)
-    logging.info("extending observed address {}".format(address))
-    self.kv.update('safe_timelock', 'addresses', {'addresses':observed_addresses})
+      observed_addresses.append(address)
+      logging.info("extending observed address {}".format(address))
+      self.kv.update('safe_timelock', 'addresses', {'addresses':observed_addresses})
 
   def save_redeem(self, addr, redeem):
     try:
@@ -65,14 +69,27 @@ class SafeTimelockCreateHandler(BaseHandler):
       # Already saved
       pass
 
+  @classmethod
+  def request_key(cls, message):
+    # the same address as create_multisig_address gives for hex pubkeys
+    keys = sorted(message['pubkey_list'])
+    address = script_to_p2sh_address(multisig_redeem_script(int(message['req_sigs']), keys))
+    return contract_key(address, get_mark_for_address(message['return_address']))
+
+  @classmethod
+  def task_key(cls, task):
+    message = json.loads(task['json_data'])
+    return contract_key(message['address'], message['mark'])
+
   def handle_request(self, request):
     message = request.message
 
     return_address = message['return_address']
     mark = get_mark_for_address(return_address)
-    address_to_pay_on = self.oracle.btc.add_multisig_address(message['req_sigs'], message['pubkey_list'])
-    retval = self.oracle.btc.create_multisig_address(message['req_sigs'], message['pubkey_list'])
-    redeemScript = retval['redeemScript']
+    multisig = self.oracle.btc.create_multisig_address(message['req_sigs'], message['pubkey_list'])
+    address_to_pay_on = multisig['address']
+    redeemScript = multisig['redeemScript']
+    self.oracle.btc.import_multisig_address(message['req_sigs'], message['pubkey_list'])
 
     self.save_redeem(address_to_pay_on, redeemScript)
 
@@ -83,7 +100,14 @@ class SafeTimelockCreateHandler(BaseHandler):
     miners_fee_satoshi = message['miners_fee_satoshi']
     req_sigs = message['req_sigs']
 
-    if self.mark_unavailable(mark, address_to_pay_on):
+    # different return addresses can share a mark, so checking and claiming
+    # it must not interleave with another request
+    with self.oracle.db.write_lock:
+      claimed = not self.mark_unavailable(mark, address_to_pay_on)
+      if claimed:
+        self.claim_mark(mark, address_to_pay_on, return_address, locktime, oracle_fees, miners_fee_satoshi, req_sigs)
+
+    if not claimed:
       reply_msg = {
         'operation': 'safe_timelock_error',
         'in_reply_to': message['message_id'],
@@ -96,9 +120,6 @@ class SafeTimelockCreateHandler(BaseHandler):
       self.oracle.broadcast_with_fastcast(json.dumps(reply_msg))
       return
 
-    # For now oracles are running single-thread so there is no race condition
-    self.claim_mark(mark, address_to_pay_on, return_address, locktime, oracle_fees, miners_fee_satoshi, req_sigs)
-
     reply_msg = { 'operation' : 'safe_timelock_created',
         'contract_id' : '{}#{}'.format(address_to_pay_on, mark),
         'comment': 'mark claimed, use {} as value sufix, you have {} minutes to send cash to address {}'.format(mark, int(TIME_FOR_TRANSACTION / 60), address_to_pay_on),
@@ -121,28 +142,34 @@ class SafeTimelockCreateHandler(BaseHandler):
         "next_check": release_time
     })
 
+  def get_vout(self, txid, n):
+    transaction = self.btc.get_decoded_transaction(txid)
+    for vout in transaction['vout']:
+      if vout['n'] == n:
+        return vout
+    return None
+
   def handle_task(self, task):
     message = cjson.decode(task['json_data'])
 
     txid = message['txid']
     n = message['n']
     redeemScript = self.kv.get_by_section_key('safe_timelock_redeem', message['address'])['redeem']
-    tx = self.btc.get_raw_transaction(txid)
-    transaction = self.btc.decode_raw_transaction(tx)
-    vout = None
-    for v in transaction['vout']:
-      if v['n'] == n:
-        vout = v
-        break
-
-    if not vout:
-      logging.info("missing vout for txid {} n {}".format(txid, n))
-      return
 
-    sum_satoshi = int(round(vout['value'] * 100000000))
-    message['sum_satoshi'] = sum_satoshi
+    utxo = ObservedUtxo(self.oracle.db).get_output(txid, n)
+    if utxo:
+      sum_satoshi = Satoshi(utxo['value_satoshi'])
+      scriptPubKey = utxo['script_pub_key']
+    else:
+      # output seen before the utxo table existed
+      vout = self.get_vout(txid, n)
+      if not vout:
+        logging.info("missing vout for txid {} n {}".format(txid, n))
+        return
+      sum_satoshi = Satoshi.from_btc(vout['value'])
+      scriptPubKey = vout['scriptPubKey']['hex']
 
-    scriptPubKey = vout['scriptPubKey']['hex']
+    message['sum_satoshi'] = sum_satoshi
 
     prevtx = {
         'txid': txid,
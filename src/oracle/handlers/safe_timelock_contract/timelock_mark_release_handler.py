@@ -7,7 +7,7 @@ import logging
 import time
 
 from oracle.oracle_db import KeyValue
-from contract_util import value_to_mark
+from contract_util import value_to_mark, contract_key
 from random import randrange
 
 class TimelockMarkReleaseHandler(BaseHandler):
@@ -16,6 +16,11 @@ class TimelockMarkReleaseHandler(BaseHandler):
     self.btc = oracle.btc
     self.kv = KeyValue(self.oracle.db)
 
+  @classmethod
+  def task_key(cls, task):
+    data = json.loads(task['json_data'])
+    return contract_key(data['address'], data['mark'])
+
   def handle_task(self, task):
     data = json.loads(task['json_data'])
 
@@ -92,20 +97,19 @@ class TimelockMarkReleaseHandler(BaseHandler):
     self.oracle.broadcast_with_fastcast(json.dumps(info_msg))
 
   def get_observed_addresses(self):
-    observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
-    if not observed_addresses:
-      self.kv.store('safe_timelock', 'addresses', {'addresses':[]})
+    with self.oracle.db.write_lock:
+      observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
+      if not observed_addresses:
+        self.kv.store('safe_timelock', 'addresses', {'addresses':[]})
 
     observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
     observed_addresses = observed_addresses['addresses']
     return observed_addresses
 
-  def handle_new_transactions(self, transactions):
-    logging.info(transactions)
-
+  def find_outputs(self, transactions):
     our_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
     if not our_addresses:
-      return
+      return []
 
     our_addresses = our_addresses['addresses']
 
@@ -118,6 +122,43 @@ class TimelockMarkReleaseHandler(BaseHandler):
           continue
         if vout['scriptPubKey']['addresses'][0] in our_addresses:
           outputs.append((value_to_mark(vout['value']), vout['scriptPubKey']['addresses'][0], vout['value'], transaction['txid'], vout['n']))
-    for output in outputs:
+    return outputs
+
+  def notify_pending_output(self, output):
+    # the timelock is created once the transaction is confirmed,
+    # for now just let the client know the payment was noticed
+    mark, address, value, txid, n = output
+
+    mark_data = self.kv.get_by_section_key('mark_available', '{}#{}'.format(mark, address))
+    if not mark_data or mark_data['available']:
+      return
+
+    logging.info("pending transaction for mark:{} on address:{}".format(mark, address))
+    info_msg = {
+      'operation': 'safe_timelock_pending_transaction',
+      'in_reply_to': 'none',
+      'message_id': "%s-%s" % ("pending_transaction", str(randrange(1000000000,9000000000))),
+      'contract_id' : "{}#{}".format(address, mark),
+      'txid': txid,
+    }
+
+    self.oracle.broadcast_with_fastcast(json.dumps(info_msg))
+
+  def handle_pending_transactions(self, transactions):
+    for output in self.find_outputs(transactions):
+      self.notify_pending_output(output)
+
+  def handle_new_transactions(self, transactions):
+    logging.info(transactions)
+
+    for output in self.find_outputs(transactions):
       self.verify_and_create_timelock(output)
 
+  def transaction_jobs(self, transactions, pending=False):
+    # one job per output, in the lane of the contract (address#mark) it pays to
+    job = self.notify_pending_output if pending else self.verify_and_create_timelock
+    jobs = []
+    for output in self.find_outputs(transactions):
+      mark, address = output[0], output[1]
+      jobs.append((contract_key(address, mark), job, (output, )))
+    return jobs
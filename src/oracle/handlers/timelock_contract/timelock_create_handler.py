@@ -12,6 +12,10 @@ class TimelockCreateHandler(BaseHandler):
     self.btc = oracle.btc
 
 
+  @classmethod
+  def task_key(cls, task):
+    return json.loads(task['json_data'])['pwtxid']
+
   def handle_request(self, request):
     message = request.message
 
@@ -1,15 +1,28 @@
 from basehandler import BaseHandler
-from oracle.oracle_db import KeyValue
+from oracle.oracle_db import KeyValue, SignLatency, SignatureVariant
 
 import json
 import logging
+import settings_local
 import time
 
-from shared.liburl_wrapper import safe_pushtx
-
 
 TURN_LENGTH_TIME = 60 * 1
 
+# Turn delays are learned from how fast earlier oracles' signatures show up
+# in fastcast: an oracle takes the TURN_DELAY_PERCENTILE of every peer's recorded
+# latencies and waits for the slowest peer, clamped to [TURN_DELAY_FLOOR,
+# TURN_DELAY_CEILING] seconds. Peers with fewer than TURN_DELAY_MIN_SAMPLES
+# don't count; without any the fixed TURN_LENGTH_TIME per turn is used.
+TURN_DELAY_PERCENTILE = getattr(settings_local, 'TURN_DELAY_PERCENTILE', 90)
+TURN_DELAY_FLOOR = getattr(settings_local, 'TURN_DELAY_FLOOR', 10)
+TURN_DELAY_CEILING = getattr(settings_local, 'TURN_DELAY_CEILING', 5 * 60)
+TURN_DELAY_MIN_SAMPLES = 5
+# latencies kept per peer and signature count
+TURN_DELAY_HISTORY = 200
+# every stored variant adds a signature, so a multisig can't need more
+MAX_SIGNATURE_VARIANTS = 16
+
 class TransactionVerificationError(Exception):
   pass
 
@@ -53,10 +66,21 @@ class TransactionSigner(BaseHandler):
       logging.debug("transaction does not include me")
       return False
 
-    if self.oracle.btc.transaction_already_signed(tx, prevtxs):
-      logging.debug("transaction already signed")
-      return False
+    return True
 
+  def signatures_count(self, state):
+    if not state:
+      return 0
+    return min(len(tx_input['signed']) for tx_input in state)
+
+  def signed_by_me(self, state):
+    # every input we hold a key for already has our signature
+    mine = [tx_input for tx_input in state if tx_input['mine']]
+    if not mine:
+      return False
+    for tx_input in mine:
+      if not set(tx_input['mine']) & set(tx_input['signed']):
+        return False
     return True
 
 
@@ -73,23 +97,87 @@ class TransactionSigner(BaseHandler):
     turns = [self.get_my_turn(vin['redeemScript']) for vin in inputs if 'redeemScript' in vin]
 
     my_turn = max(turns)
-    add_time = (my_turn - 1) * TURN_LENGTH_TIME
+    add_time = self.turn_delay(my_turn)
 
     rq_hash = self.get_tx_hash(tx)
     logging.info("sign -> rq_hash: {}".format(rq_hash))
 
-    try:
-      self.kv.store( 'signable', rq_hash, { 'inputs':inputs, 'sigs_so_far':0, 'req_sigs': req_sigs , 'pwtxid' : pwtxid } )
-    except:
-      logging.warning('duplicate sign task? this try..except should be removed ultimately!')
+    if not self.oracle.signing.create(rq_hash, pwtxid, inputs, req_sigs):
+      logging.warning('duplicate sign task for rq_hash {}'.format(rq_hash))
 
     self.oracle.task_queue.save({
         "operation": 'sign',
-        "json_data": json.dumps({"transaction": tx}),
+        "json_data": json.dumps({"transaction": tx, "pwtxid": pwtxid}),
         "next_check": time.time() + add_time,
         "done": 0,
+        "dedup_key": 'sign:{}'.format(rq_hash),
     })
 
+  def merge_variants(self, rq_hash, tx, inputs):
+    # tx is kept only if it's a copy of the stored variants with a valid
+    # signature they don't have yet, so junk can't pile up
+    variants = SignatureVariant(self.oracle.db)
+    stored = variants.get_variants(rq_hash)
+
+    if stored:
+      known = self.btc.merge_signatures(stored[0], stored[1:], inputs)
+      merged, added = self.btc.add_signatures(known, tx, inputs)
+    else:
+      merged = tx
+      added = sum(len(tx_input['signed']) for tx_input in self.btc.signature_state(tx, inputs))
+
+    if added and len(stored) < MAX_SIGNATURE_VARIANTS:
+      variants.save({'rq_hash': rq_hash, 'tx': tx})
+    if stored:
+      logging.debug('merged signatures of %r variants' % (len(stored) + 1))
+    return merged
+
+  def turn_delay(self, my_turn):
+    # turns are counted from 0, oracle with turn n expects signatures of the n oracles before it
+    sigs = my_turn
+    if sigs <= 0:
+      return 0
+
+    # a percentile per peer that delivered the n-th signature, so one slow
+    # oracle isn't hidden among the fast ones
+    latency_db = SignLatency(self.oracle.db)
+    delays = []
+    for peer in latency_db.peers(sigs):
+      latencies = sorted(latency_db.recent(sigs, peer, TURN_DELAY_HISTORY))
+      if len(latencies) < TURN_DELAY_MIN_SAMPLES:
+        continue
+      idx = min(len(latencies) - 1, len(latencies) * TURN_DELAY_PERCENTILE // 100)
+      delays.append(latencies[idx])
+
+    if not delays:
+      return sigs * TURN_LENGTH_TIME
+
+    delay = min(max(max(delays), TURN_DELAY_FLOOR), TURN_DELAY_CEILING)
+    logging.debug('turn %r delay %r (from %r peers)' % (my_turn, delay, len(delays)))
+    return delay
+
+  def record_latency(self, request):
+    # remembers how long it took for a peer's signature to arrive after our request
+    body = request.message
+    if request.from_address == self.kv.get_by_section_key('fastcast', 'address')['pub']:
+      return
+    if not 'sigs' in body:
+      return
+
+    rq_data = self.oracle.signing.get(self.get_tx_hash(body['transaction']))
+    if not rq_data or not rq_data['requested_at']:
+      return
+
+    latency = request.received_time - rq_data['requested_at']
+    if latency < 0:
+      # peer signed before we got to our request
+      latency = 0
+
+    sigs = int(body['sigs'])
+    latency_db = SignLatency(self.oracle.db)
+    latency_db.save({'peer': request.from_address, 'sigs': sigs, 'latency': latency})
+    latency_db.prune(sigs, request.from_address, TURN_DELAY_HISTORY)
+
   def sign_now(self, tx):
     # sign now signs the transaction and broadcasts it over the network
 
@@ -97,7 +185,7 @@ class TransactionSigner(BaseHandler):
 
     rq_hash = self.get_tx_hash(tx)
 
-    rq_data = self.kv.get_by_section_key('signable', rq_hash)
+    rq_data = self.oracle.signing.get(rq_hash)
     if rq_data is None:
       logging.debug("not scheduled to sign this")
       return
@@ -108,9 +196,14 @@ class TransactionSigner(BaseHandler):
 
     assert( self.is_proper_transaction(tx, inputs) )
 
-    tx_sigs_count = self.btc.signatures_count(
-        tx,
-        inputs)
+    # copies signed by different oracles are combined, together
+    # they may already have all the signatures we need
+    tx = self.merge_variants(rq_hash, tx, inputs)
+
+    # which keys signed which input, checked locally so that signing
+    # below is the only call that needs our private keys
+    state = self.btc.signature_state(tx, inputs)
+    tx_sigs_count = self.signatures_count(state)
 
     logging.debug("sigs count so far: %r; req_sigs: %r" % (tx_sigs_count, req_sigs))
 
@@ -118,36 +211,54 @@ class TransactionSigner(BaseHandler):
       logging.debug('already signed a transaction with more sigs')
       return
 
-    rq_data['sigs_so_far'] = tx_sigs_count
-    self.kv.update('signable', rq_hash, rq_data)
-    # ^ let's remember the tx with most sigs that we've seen.
-
     if tx_sigs_count >= req_sigs:
+      if tx_sigs_count > sigs_so_far:
+        logging.info('merged signatures complete the transaction, pushing it')
+        self.oracle.broadcaster.enqueue(tx)
+        self.oracle.signing.update(rq_hash, tx_sigs_count)
       logging.debug('already signed with enough keys')
       return
 
+    if self.signed_by_me(state):
+      logging.debug("transaction already signed by me")
+      return
+
+    self.oracle.signing.update(rq_hash, tx_sigs_count)
+    # ^ let's remember the tx with most sigs that we've seen.
+
     pwtxid = rq_data['pwtxid']
 
     signed_transaction = self.btc.sign_transaction(tx, inputs)
 
-    tx_new_sigs_count = self.btc.signatures_count(signed_transaction, inputs)
+    tx_new_sigs_count = self.signatures_count(self.btc.signature_state(signed_transaction, inputs))
 
     if (tx_new_sigs_count == tx_sigs_count):
       logging.debug('failed signing transaction. already signed by me? aborting')
       return
 
-    tx_sigs_count += 1
+    tx_sigs_count = tx_new_sigs_count
+    SignatureVariant(self.oracle.db).save({'rq_hash': rq_hash, 'tx': signed_transaction})
 
     body = { 'pwtxid': pwtxid, 'operation':'sign', 'transaction': signed_transaction, 'sigs': tx_sigs_count, 'req_sigs': req_sigs }
     logging.debug('broadcasting: %r' % body)
     self.oracle.broadcast_with_fastcast(json.dumps(body))
 
     if tx_sigs_count == req_sigs:
-      safe_pushtx(signed_transaction)
-      self.oracle.btc.send_transaction(signed_transaction)
+      self.oracle.broadcaster.enqueue(signed_transaction)
 
-    rq_data['sigs_so_far'] = tx_sigs_count
-    self.kv.update('signable', rq_hash, rq_data)
+    self.oracle.signing.update(rq_hash, tx_sigs_count)
+
+  @classmethod
+  def request_key(cls, message):
+    return message['pwtxid']
+
+  @classmethod
+  def task_key(cls, task):
+    message = json.loads(task['json_data'])
+    if 'pwtxid' in message:
+      return message['pwtxid']
+    # tasks scheduled before pwtxid was stored with them
+    return message['transaction']
 
   def handle_request(self, request):
     body = request.message
@@ -156,6 +267,11 @@ class TransactionSigner(BaseHandler):
 
     tx = body['transaction']
 
+    try:
+      self.record_latency(request)
+    except:
+      logging.exception('problem recording signature latency')
+
     self.sign_now(tx)
 
   def handle_task(self, task):
@@ -169,8 +285,10 @@ class TransactionSigner(BaseHandler):
 
     rq_hash = self.get_tx_hash(tx)
 
-    rq_data = self.kv.get_by_section_key('signable', rq_hash)
-    assert(rq_data is not None)
+    rq_data = self.oracle.signing.get(rq_hash)
+    if rq_data is None:
+      logging.debug('signing of {} expired or finished'.format(rq_hash))
+      return
 
     logging.info("rq_data: %r" % rq_data)
 
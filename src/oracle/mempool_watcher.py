@@ -0,0 +1,96 @@
+from oracle_db import PendingTransaction
+from shared.bitcoind_client.rawtransaction import parse_raw_transaction
+from shared.bitcoind_client.script import address_to_script, InvalidAddressError
+
+import json
+import logging
+
+class MempoolWatcher:
+  """
+  Notices transactions to observed addresses as soon as they enter the mempool,
+  by diffing getrawmempool snapshots. Matches are kept as pending, so when
+  their block comes they only need to be promoted.
+  New transactions are matched on their raw outputs, only the matches get
+  decoded and cached.
+  """
+  def __init__(self, oracle):
+    self.oracle = oracle
+    self.btc = oracle.btc
+    self.snapshot = None
+    self.enabled = self.btc.serves_mempool()
+    if not self.enabled:
+      logging.info('backend has no mempool, transactions are seen when mined')
+
+  def poll(self, addresses):
+    """
+    Returns {address: [transaction]} for new mempool transactions paying to addresses
+    """
+    if not self.enabled:
+      return {}
+
+    mempool = set(self.btc.get_raw_mempool())
+
+    if self.snapshot is None:
+      # whatever is already there will be found when its block is scanned
+      self.snapshot = mempool
+      return {}
+
+    new_txids = mempool - self.snapshot
+    self.snapshot = mempool
+    return self.match(new_txids, addresses)
+
+  def address_scripts(self, addresses):
+    scripts = {}
+    for address in addresses:
+      try:
+        scripts[address_to_script(address)] = address
+      except (InvalidAddressError, ValueError):
+        logging.warning('observed address %r is not valid' % address)
+    return scripts
+
+  def match(self, txids, addresses):
+    scripts = self.address_scripts(addresses)
+    pending_transactions = PendingTransaction(self.oracle.db)
+
+    matches = {}
+    for txid in txids:
+      if pending_transactions.get_by_txid(txid):
+        continue
+
+      try:
+        raw_transaction = self.btc.get_mempool_transaction(txid)
+        outputs = parse_raw_transaction(raw_transaction)['outputs']
+      except:
+        # could've left the mempool in the meantime
+        logging.debug('problem fetching mempool tx %r' % txid)
+        continue
+
+      matched = set(scripts[output['script']] for output in outputs if output['script'] in scripts)
+      if not matched:
+        continue
+
+      transaction = self.btc.cache_transaction(txid, raw_transaction)
+      if not transaction:
+        continue
+
+      logging.info('pending transaction %r to %r' % (txid, list(matched)))
+      pending_transactions.save({'txid': txid, 'json_data': json.dumps(transaction)})
+      for address in matched:
+        matches.setdefault(address, []).append(transaction)
+
+    return matches
+
+  def promote(self, block):
+    """
+    Returns {txid: transaction} of pending transactions confirmed in block
+    """
+    pending_transactions = PendingTransaction(self.oracle.db)
+
+    confirmed = {}
+    for txid in block['tx']:
+      pending = pending_transactions.get_by_txid(txid)
+      if not pending:
+        continue
+      confirmed[txid] = json.loads(pending['json_data'])
+      pending_transactions.promote(txid)
+    return confirmed
@@ -1,6 +1,6 @@
 # Main Oracle file
 
-from oracle_db import OracleDb, TaskQueue, KeyValue
+from oracle_db import OracleDb, TaskQueue, KeyValue, ObservedUtxo
 from handlers.handlers import op_handlers
 
 from settings_local import ORACLE_ADDRESS, ORACLE_FEE
@@ -13,11 +13,19 @@ from shared.fastproto import(
 import json
 
 from handlers.transactionsigner import TransactionSigner
+from handlers.bounty_contract.keypair_pool import KeypairPool
+from handlers.bounty_contract import guess_decryptor
+from worker_pool import KeyedWorkerPool, WORKER_POOL_SIZE
+from broadcaster import TransactionBroadcaster, push_endpoints
+from mempool_watcher import MempoolWatcher
+from signing_state import SigningIndex
 
 import time
 import logging
+import threading
+import traceback
 
-from decimal import Decimal
+from shared.satoshi import Satoshi
 
 # 3 minutes between oracles should be sufficient
 HEURISTIC_ADD_TIME = 60 * 3
@@ -48,7 +56,16 @@ class FastcastProtocolError(Exception):
   pass
 
 class Oracle:
-  def __init__(self):
+  def __init__(self, pool_size=WORKER_POOL_SIZE, start_height=None):
+
+    # first block to scan on a fresh database, defaults to the newest confirmed one
+    self.start_height = start_height
+
+    # the key generating and guess decrypting processes are forked first, while
+    # there are no threads or database connections yet that they would inherit
+    self.keypair_pool = KeypairPool()
+    self.keypair_pool.start()
+    guess_decryptor.start_pool()
 
     self.db = OracleDb()
     self.btc = BitcoinClient()
@@ -59,6 +76,14 @@ class Oracle:
     self.handlers = op_handlers
     self.signer = TransactionSigner(self)
 
+    self.pool = KeyedWorkerPool(pool_size)
+    self.tasks_in_flight = set()
+    self.tasks_in_flight_lock = threading.Lock()
+
+    self.broadcaster = TransactionBroadcaster(self.db, push_endpoints(self.btc))
+    self.mempool = MempoolWatcher(self)
+    self.signing = SigningIndex(self.db)
+
     last_received = self.kv.get_by_section_key('fastcast', 'last_epoch')
     if not last_received:
       self.kv.store('fastcast', 'last_epoch', {'last':0})
@@ -101,6 +126,71 @@ class Oracle:
     if db_class:
       db_class(self.db).save(message)
 
+  def request_key(self, request):
+    operation, message = request
+
+    if not operation in self.handlers:
+      return operation
+
+    try:
+      body = json.loads(message.message)
+      return self.handlers[operation].request_key(body)
+    except:
+      return operation
+
+  def task_key(self, task):
+    operation = task['operation']
+
+    if not operation in self.handlers:
+      return operation
+
+    try:
+      return self.handlers[operation].task_key(task)
+    except:
+      return operation
+
+  def submit_request(self, request):
+    self.pool.submit(self.request_key(request), self.handle_request, request)
+
+  def submit_task(self, task):
+    with self.tasks_in_flight_lock:
+      if task['id'] in self.tasks_in_flight:
+        # still queued or running from the previous cycle
+        return
+      self.tasks_in_flight.add(task['id'])
+
+    self.pool.submit(self.task_key(task), self.run_task, task)
+
+  def submit_transactions(self, handler, transactions, pending=False):
+    # in the same lanes as the requests and tasks of the contracts
+    return [self.pool.submit(key, fun, *args)
+        for key, fun, args in handler(self).transaction_jobs(transactions, pending)]
+
+  def run_task(self, task):
+    try:
+      self.handle_task(task)
+      self.task_queue.done(task)
+    except:
+      logging.exception('task %r failed' % task['id'])
+      # quarantine the failing contract, other tasks keep flowing
+      self.task_queue.failed(task, traceback.format_exc())
+    finally:
+      with self.tasks_in_flight_lock:
+        self.tasks_in_flight.discard(task['id'])
+
+  def report_metrics(self):
+    logging.info('worker pool: %r jobs queued or running for %r keys' % (
+        self.pool.queue_depth(),
+        self.pool.busy_keys()))
+    self.keypair_pool.ensure_running()
+    logging.info('rsa keypair pool: %r keys ready' % self.keypair_pool.available(self.db))
+    logging.info('signing: %r entries in memory' % self.signing.count())
+    logging.info('bitcoind single-flight: %(calls)r calls, %(deduplicated)r deduplicated, %(in_flight)r in flight' % self.btc.single_flight.stats())
+    if self.btc.read_balancer:
+      logging.info('bitcoind read backends: %r of %r healthy' % (
+          self.btc.read_balancer.healthy_count(),
+          len(self.btc.read_balancer.backends)))
+
   def get_last_block_number(self):
     val = KeyValue(self.db).get_by_section_key('blocks', 'last_block_number')
     if not val:
@@ -110,20 +200,16 @@ class Oracle:
     return last_block
 
   def set_last_block(self):
-    last_block_number = self.btc.get_block_count()
+    if self.start_height is not None:
+      # blocks after last_block_number get scanned
+      last_block_number = self.start_height - 1
+    else:
+      # We need to satisfy a condition on looking only for blocks with at
+      # least CONFIRMATIONS of confirmations: tip - height + 1 >= CONFIRMATIONS
+      tip_height = self.btc.get_tip_height()
+      last_block_number = min(tip_height, tip_height - CONFIRMATIONS + 1)
 
-    # We need to satisfy a condition on looking only for blocks with at
-    # least CONFIRMATIONS of confirmations
-    satisfied = False
-
-    while not satisfied:
-      block_hash = self.btc.get_block_hash(last_block_number)
-      block = self.btc.get_block(block_hash)
-      if block['confirmations'] >= CONFIRMATIONS:
-        satisfied = True
-      else:
-        last_block_number -= 1
-        print "not enough confirmations - checking previous block %r" % last_block_number
+    logging.info("starting from block %r" % last_block_number)
 
     KeyValue(self.db).store('blocks', 'last_block_number', {'last_block':last_block_number})
     return last_block_number
@@ -138,6 +224,10 @@ class Oracle:
 
     newer_block = last_block_number + 1
 
+    # We are waiting for enough confirmations (and for the block to exist at all)
+    if self.btc.confirmations(newer_block) < max(CONFIRMATIONS, 1):
+      return None
+
     block_hash = self.btc.get_block_hash(newer_block)
 
     logging.info("block hash: %r" % block_hash)
@@ -146,13 +236,64 @@ class Oracle:
 
     block = self.btc.get_block(block_hash)
 
-    # We are waiting for enough confirmations
-    if block['confirmations'] < CONFIRMATIONS:
-      return None
-
     logging.info("New block {}".format(newer_block))
     return block
 
+  def get_observed_addresses(self):
+    addresses_per_handler = {}
+    all_addresses = set()
+
+    # Every handler can wait for transactions occuring on some addresses
+    for name, handler in op_handlers.iteritems():
+      addresses = handler(self).get_observed_addresses()
+      addresses_per_handler[name] = addresses
+      for address in addresses:
+        all_addresses.add(address)
+
+    return addresses_per_handler, all_addresses
+
+  def transactions_per_handler(self, transactions, addresses_per_handler):
+    for name, handler in op_handlers.iteritems():
+      addresses = addresses_per_handler[name]
+      handler_transactions = []
+      for address in addresses:
+        if address in transactions:
+          handler_transactions.extend(transactions[address])
+      yield handler, handler_transactions
+
+  def track_utxos(self, transactions, spent_outputs, height):
+    """
+    Stores outputs to observed addresses, and marks the ones spent by
+    any of the scanned transactions
+    """
+    utxos = ObservedUtxo(self.db)
+    for address, address_transactions in transactions.iteritems():
+      for transaction in address_transactions:
+        for vout in transaction['vout']:
+          if not address in vout['scriptPubKey'].get('addresses', []):
+            continue
+          utxos.save({
+            'txid': transaction['txid'],
+            'n': vout['n'],
+            'address': address,
+            'value_satoshi': Satoshi.from_btc(vout['value']),
+            'script_pub_key': vout['scriptPubKey']['hex'],
+            'height': height
+          })
+
+    # a release pays somewhere else, so spends come from all the transactions
+    utxos.mark_spent_many(spent_outputs)
+
+  def check_mempool(self):
+    addresses_per_handler, all_addresses = self.get_observed_addresses()
+    transactions = self.mempool.poll(all_addresses)
+    if not transactions:
+      return
+
+    for handler, handler_transactions in self.transactions_per_handler(transactions, addresses_per_handler):
+      if handler_transactions:
+        self.submit_transactions(handler, handler_transactions, pending=True)
+
   def handle_task(self, task):
     operation = task['operation']
 
@@ -177,7 +318,8 @@ class Oracle:
   def is_fee_sufficient(self, addr, fee):
     if addr != self.oracle_address:
       return False
-    if fee < Decimal(ORACLE_FEE):
+    # fee is in satoshi
+    if fee < Satoshi.from_btc(ORACLE_FEE):
       return False
     return True
 
@@ -230,6 +372,8 @@ class Oracle:
     logging.info("my bitcoin address is %s" % self.oracle_address)
     logging.info( "my bitcoin pubkey: %r" % self.btc.validate_address(self.oracle_address)['pubkey'] )
 
+    self.broadcaster.start()
+
     while True:
       # Proceed all requests
       requests = getMessages()
@@ -248,45 +392,51 @@ class Oracle:
           logging.info('message does not have all required fields')
           logging.info(prev_request)
           continue
-        self.handle_request(request)
+        self.submit_request(request)
 
+      for task in self.task_queue.get_all_tasks():
+        self.submit_task(task)
 
-      task = self.task_queue.get_oldest_task()
-      while task is not None:
-        self.handle_task(task)
-        self.task_queue.done(task)
-        task = self.task_queue.get_oldest_task()
+      self.report_metrics()
 
       try:
+        self.signing.sweep_if_due()
+      except:
+        logging.exception('problem sweeping signing state')
+
+      try:
+        self.btc.refresh_tip()
         new_block = self.get_new_block()
       except:
         new_block = None
         logging.exception('problematic block!')
 
+      try:
+        self.check_mempool()
+      except:
+        logging.exception('problem checking mempool')
+
       if new_block:
-        handlers = op_handlers.iteritems()
-
-        addresses_per_handler = {}
-        all_addresses = set()
-
-        # Every handler can wait for transactions occuring on some addresses
-        for name, handler in handlers:
-          addresses = handler(self).get_observed_addresses()
-          addresses_per_handler[name] = addresses
-          for address in addresses:
-            all_addresses.add(address)
-
-        transactions = self.btc.get_transactions_from_block(new_block, list(all_addresses))
-
-        handlers = op_handlers.iteritems()
-        for name, handler in handlers:
-          addresses = addresses_per_handler[name]
-          handler_transactions = []
-          for address in addresses:
-            if address in transactions:
-              handler_transactions.extend(transactions[address])
-          handler(self).handle_new_transactions(handler_transactions)
-
-        KeyValue(self.db).update('blocks', 'last_block_number', {'last_block':new_block['height']})
+        addresses_per_handler, all_addresses = self.get_observed_addresses()
+
+        # transactions already seen in mempool don't have to be fetched again
+        known_transactions = self.mempool.promote(new_block)
+        spent_outputs = set()
+        transactions = self.btc.get_transactions_from_block(new_block, list(all_addresses), known_transactions, spent_outputs)
+
+        self.track_utxos(transactions, spent_outputs, new_block['height'])
+
+        jobs = []
+        for handler, handler_transactions in self.transactions_per_handler(transactions, addresses_per_handler):
+          if handler_transactions:
+            jobs.extend(self.submit_transactions(handler, handler_transactions))
+
+        # the block counts as handled only once all of its transactions are,
+        # otherwise it's scanned again
+        results = [job.wait() for job in jobs]
+        if all(results):
+          KeyValue(self.db).update('blocks', 'last_block_number', {'last_block':new_block['height']})
+        else:
+          logging.error('handling block %r failed, it will be scanned again' % new_block['height'])
 
       time.sleep(10)
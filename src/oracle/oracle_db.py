@@ -1,11 +1,19 @@
 from collections import defaultdict
 from shared.db_classes import TableDb, GeneralDb
+from shared.utxo_db import ObservedUtxo
 
 import json
+import logging
 import time
 
 ORACLE_FILE = 'oracle.db'
 
+# failing tasks are retried after 30s, 1min, 2min... but not later than after an hour
+TASK_RETRY_BASE_TIME = 30
+TASK_RETRY_MAX_TIME = 60 * 60
+# after that many failures task goes to the dead letter table
+TASK_MAX_ATTEMPTS = 10
+
 class KeyValue(TableDb):
   table_name = 'key_value'
   create_sql = 'create table {0} ( \
@@ -101,15 +109,50 @@ class TaskQueue(TableDb):
       operation text not null, \
       json_data text not null, \
       next_check integer not null, \
-      done integer default 0);"
-  insert_sql = "insert into {0} (operation, json_data, next_check, done) values (?,?,?,?)"
+      done integer default 0, \
+      attempts integer default 0, \
+      dedup_key text);"
+  extra_columns = [
+      ('attempts', 'integer default 0'),
+      ('dedup_key', 'text')]
+  indexes = ['dedup_key']
+  insert_sql = "insert into {0} (operation, json_data, next_check, done, dedup_key) values (?,?,?,?,?)"
   oldest_sql = "select * from {0} where next_check<? and done=0 order by ts limit 1"
   all_sql = "select * from {0} where next_check<? and done=0 order by ts"
-  all_ignore_sql = "select * from {0} where done=0 order by ts"
   mark_done_sql = "update {0} set done=1 where id=?"
+  retry_sql = "update {0} set attempts=?, next_check=?, done=0 where id=?"
+  dedup_sql = "select * from {0} where dedup_key=? and done=0 order by id limit 1"
+  merge_sql = "update {0} set next_check=min(next_check, ?) where id=?"
 
   def args_for_obj(self, obj):
-    return [obj['operation'], obj['json_data'], obj['next_check'], obj['done']]
+    return [obj['operation'], obj['json_data'], obj['next_check'], obj['done'], obj.get('dedup_key')]
+
+  def save(self, obj):
+    """
+    Tasks saved with a dedup_key are merged into a pending task with the same key,
+    the merged task keeps the earliest next_check
+    """
+    dedup_key = obj.get('dedup_key')
+    if dedup_key is None:
+      return super(TaskQueue, self).save(obj)
+
+    with self.db.write_lock:
+      pending = self.get_by_dedup_key(dedup_key)
+      if pending is None:
+        return super(TaskQueue, self).save(obj)
+
+      logging.debug('task %r already pending, merging' % dedup_key)
+      sql = self.merge_sql.format(self.table_name)
+      self.execute_sql_properly(sql, (obj['next_check'], pending['id']))
+
+  def get_by_dedup_key(self, dedup_key):
+    cursor = self.db.get_cursor()
+    sql = self.dedup_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (dedup_key, )).fetchone()
+    if row:
+      row = dict(row)
+    return row
 
   def get_oldest_task(self):
     cursor = self.db.get_cursor()
@@ -128,18 +171,63 @@ class TaskQueue(TableDb):
     rows = [dict(row) for row in rows]
     return rows
 
-  def get_all_ignore_checks(self):
-    cursor = self.db.get_cursor()
-    sql = self.all_ignore_sql.format(self.table_name)
+  def iter_all_ignore_checks(self, columns=None):
+    return self.iterate(columns, where='done=0')
 
-    rows = cursor.execute(sql).fetchall()
-    rows = [dict(row) for row in rows]
-    return rows
+  def get_all_ignore_checks(self):
+    return list(self.iter_all_ignore_checks())
 
   def done(self, task):
-    cursor = self.db.get_cursor()
     sql = self.mark_done_sql.format(self.table_name)
-    cursor.execute(sql, (int(task['id']), ))
+    self.execute_sql_properly(sql, (int(task['id']), ))
+
+  def retry(self, task):
+    """
+    Schedules failed task once again, with exponential backoff kept in next_check.
+    Returns False if the task already used all of its attempts.
+    """
+    attempts = (task.get('attempts') or 0) + 1
+    if attempts >= TASK_MAX_ATTEMPTS:
+      return False
+
+    delay = min(TASK_RETRY_BASE_TIME * 2 ** (attempts - 1), TASK_RETRY_MAX_TIME)
+    sql = self.retry_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (attempts, int(time.time()) + delay, int(task['id'])))
+    return True
+
+  def failed(self, task, error):
+    """
+    Retries the task, or moves it to dead tasks once it used all of its attempts
+    """
+    if self.retry(task):
+      return
+
+    logging.error('task %r failed too many times, moving it to dead tasks' % task['id'])
+    DeadTask(self.db).save({
+        'task_id': task['id'],
+        'operation': task['operation'],
+        'json_data': task['json_data'],
+        'attempts': (task.get('attempts') or 0) + 1,
+        'error': error})
+    self.done(task)
+
+class DeadTask(TableDb):
+  """
+  Tasks that kept failing - kept for investigation, never retried automatically
+  """
+  table_name = "dead_task"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      task_id integer not null, \
+      operation text not null, \
+      json_data text not null, \
+      attempts integer not null, \
+      error text not null);"
+  insert_sql = "insert into {0} (task_id, operation, json_data, attempts, error) values (?,?,?,?,?)"
+
+  def args_for_obj(self, obj):
+    return [obj['task_id'], obj['operation'], obj['json_data'], obj['attempts'], obj['error']]
 
 class UsedInput(TableDb):
   """
@@ -179,19 +267,10 @@ class SignedTransaction(TableDb):
       hex_transaction text not null, \
       prevtx text not null)"
   insert_sql = "insert into {0} (hex_transaction, prevtx) values (?, ?)"
-  all_sql = "select * from {0} order by ts"
 
   def args_for_obj(self, obj):
     return [obj["hex_transaction"], obj["prevtx"]]
 
-  def get_all(self):
-    cursor = self.db.get_cursor()
-    sql = self.all_sql.format(self.table_name)
-
-    rows = cursor.execute(sql).fetchall()
-    rows = [dict(row) for row in rows]
-    return rows
-
 
 class HandledTransaction(TableDb):
   """
@@ -220,12 +299,209 @@ class HandledTransaction(TableDb):
       return row['max_sigs']
     else:
       sql = self.insert_sql.format(self.table_name)
-      cursor.execute(sql, (rqhs, 0))
+      self.execute_sql_properly(sql, (rqhs, 0))
     return 0
 
   def update_tx(self, rqhs, sigs):
     self.save({"rqhs":rqhs, "max_sigs":sigs})
 
 
+class PendingBroadcast(TableDb):
+  """
+  Fully signed transactions waiting to be pushed to the network, kept in db
+  so they survive restarts
+  """
+  table_name = "pending_broadcast"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      tx text unique, \
+      next_try integer not null, \
+      attempts integer default 0, \
+      done integer default 0);"
+  insert_sql = "insert or ignore into {0} (tx, next_try) values (?, ?)"
+  due_sql = "select * from {0} where next_try<=? and done=0 order by id"
+  retry_sql = "update {0} set attempts=?, next_try=? where id=?"
+  mark_done_sql = "update {0} set done=? where id=?"
+
+  # done values
+  BROADCASTED = 1
+  GAVE_UP = 2
+
+  def args_for_obj(self, obj):
+    return [obj['tx'], obj['next_try']]
+
+  def get_due(self):
+    cursor = self.db.get_cursor()
+    sql = self.due_sql.format(self.table_name)
+
+    rows = cursor.execute(sql, (int(time.time()), )).fetchall()
+    return [dict(row) for row in rows]
+
+  def retry(self, pending, next_try):
+    sql = self.retry_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (pending['attempts'] + 1, next_try, pending['id']))
+
+  def done(self, pending, state=BROADCASTED):
+    sql = self.mark_done_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (state, pending['id']))
+
+
+class PendingTransaction(TableDb):
+  """
+  Transactions to observed addresses seen in the mempool, before they got
+  confirmed. json_data keeps the decoded transaction.
+  """
+  table_name = "pending_transaction"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      txid text unique, \
+      json_data text not null, \
+      promoted integer default 0);"
+  insert_sql = "insert or ignore into {0} (txid, json_data) values (?, ?)"
+  txid_sql = "select * from {0} where txid=?"
+  promote_sql = "update {0} set promoted=1 where txid=?"
+
+  def args_for_obj(self, obj):
+    return [obj['txid'], obj['json_data']]
 
+  def get_by_txid(self, txid):
+    cursor = self.db.get_cursor()
+    sql = self.txid_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (txid, )).fetchone()
+    if row:
+      return dict(row)
+    return None
+
+  def promote(self, txid):
+    sql = self.promote_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (txid, ))
+
+
+class SignLatency(TableDb):
+  """
+  How long after our sign request a peer's signature showed up in fastcast,
+  by peer and the number of signatures the peer's transaction carried
+  """
+  table_name = "sign_latency"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      peer text not null, \
+      sigs integer not null, \
+      latency real not null);"
+  insert_sql = "insert into {0} (peer, sigs, latency) values (?, ?, ?)"
+  peers_sql = "select distinct peer from {0} where sigs=?"
+  recent_sql = "select latency from {0} where sigs=? and peer=? order by id desc limit ?"
+  prune_sql = "delete from {0} where sigs=? and peer=? and id not in \
+      (select id from {0} where sigs=? and peer=? order by id desc limit ?)"
+
+  indexes = ['sigs', 'peer']
+
+  def args_for_obj(self, obj):
+    return [obj['peer'], obj['sigs'], obj['latency']]
+
+  def peers(self, sigs):
+    cursor = self.db.get_cursor()
+    sql = self.peers_sql.format(self.table_name)
+
+    rows = cursor.execute(sql, (sigs, )).fetchall()
+    return [row['peer'] for row in rows]
+
+  def recent(self, sigs, peer, limit):
+    cursor = self.db.get_cursor()
+    sql = self.recent_sql.format(self.table_name)
+
+    rows = cursor.execute(sql, (sigs, peer, limit)).fetchall()
+    return [row['latency'] for row in rows]
+
+  def prune(self, sigs, peer, keep):
+    sql = self.prune_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (sigs, peer, sigs, peer, keep))
+
+
+class SignatureVariant(TableDb):
+  """
+  Every partially signed copy of a transaction we've seen, by rq_hash;
+  their signatures get merged into one transaction
+  """
+  table_name = "signature_variant"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      rq_hash text not null, \
+      tx text not null, \
+      unique (rq_hash, tx));"
+  insert_sql = "insert or ignore into {0} (rq_hash, tx) values (?, ?)"
+  variants_sql = "select tx from {0} where rq_hash=? order by id"
+  delete_sql = "delete from {0} where rq_hash=?"
+
+  def args_for_obj(self, obj):
+    return [obj['rq_hash'], obj['tx']]
+
+  def args_for_obj_delete(self, obj):
+    return [obj['rq_hash']]
+
+  def get_variants(self, rq_hash):
+    cursor = self.db.get_cursor()
+    sql = self.variants_sql.format(self.table_name)
+
+    rows = cursor.execute(sql, (rq_hash, )).fetchall()
+    return [row['tx'] for row in rows]
+
+
+class SigningState(TableDb):
+  """
+  Transactions this oracle is signing, by rq_hash. Rows are swept after
+  their deadline, see SigningIndex
+  """
+  table_name = "signing_state"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      rq_hash text unique, \
+      pwtxid text, \
+      req_sigs integer not null, \
+      sigs_so_far integer default 0, \
+      inputs text not null, \
+      requested_at real, \
+      deadline integer not null, \
+      done integer default 0);"
+  insert_sql = "insert or ignore into {0} (rq_hash, pwtxid, req_sigs, sigs_so_far, inputs, requested_at, deadline) \
+      values (?,?,?,?,?,?,?)"
+  get_sql = "select * from {0} where rq_hash=?"
+  update_sql = "update {0} set sigs_so_far=?, done=?, deadline=? where rq_hash=?"
+  expired_sql = "select rq_hash from {0} where deadline<?"
+  delete_sql = "delete from {0} where rq_hash=?"
+
+  indexes = ['deadline']
+
+  def args_for_obj(self, obj):
+    return [obj['rq_hash'], obj['pwtxid'], obj['req_sigs'], obj['sigs_so_far'],
+        json.dumps(obj['inputs']), obj['requested_at'], obj['deadline']]
+
+  def args_for_obj_update(self, obj):
+    return [obj['sigs_so_far'], obj['done'], obj['deadline'], obj['rq_hash']]
+
+  def args_for_obj_delete(self, obj):
+    return [obj['rq_hash']]
+
+  def get(self, rq_hash):
+    cursor = self.db.get_cursor()
+    sql = self.get_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (rq_hash, )).fetchone()
+    if not row:
+      return None
+    row = dict(row)
+    row['inputs'] = json.loads(row['inputs'])
+    return row
+
+  def get_expired(self, now):
+    cursor = self.db.get_cursor()
+    sql = self.expired_sql.format(self.table_name)
 
+    rows = cursor.execute(sql, (now, )).fetchall()
+    return [row['rq_hash'] for row in rows]
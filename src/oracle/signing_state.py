@@ -0,0 +1,123 @@
+from oracle_db import KeyValue, SigningState, SignatureVariant
+
+import logging
+import threading
+import time
+
+# how long we keep trying to collect signatures for a transaction
+SIGNING_TTL = 7 * 24 * 60 * 60
+# completed transactions are kept a bit, so late sign messages are recognized
+SIGNING_DONE_GRACE = 60 * 60
+SIGNING_SWEEP_INTERVAL = 10 * 60
+
+class SigningIndex:
+  """
+  In-flight signing state by rq_hash: the signing_state table with an
+  in-memory index in front of it. Entries past their deadline (or completed
+  and past the grace period) are swept together with their signature variants.
+  """
+  def __init__(self, db):
+    self.db = db
+    self.lock = threading.Lock()
+    self.entries = {}
+    self.last_sweep = 0
+
+  def create(self, rq_hash, pwtxid, inputs, req_sigs):
+    now = time.time()
+    entry = {
+      'rq_hash': rq_hash,
+      'pwtxid': pwtxid,
+      'inputs': inputs,
+      'req_sigs': req_sigs,
+      'sigs_so_far': 0,
+      'requested_at': now,
+      'deadline': int(now + SIGNING_TTL),
+      'done': 0,
+    }
+    with self.lock:
+      if self.get_locked(rq_hash):
+        return False
+      SigningState(self.db).save(entry)
+      self.entries[rq_hash] = entry
+    return True
+
+  def get(self, rq_hash):
+    """
+    Returns a copy of the entry, None if we're not signing rq_hash
+    """
+    with self.lock:
+      entry = self.get_locked(rq_hash)
+      if entry:
+        return dict(entry)
+      return None
+
+  def get_locked(self, rq_hash):
+    if rq_hash in self.entries:
+      return self.entries[rq_hash]
+
+    entry = SigningState(self.db).get(rq_hash)
+    if not entry:
+      entry = self.migrate_legacy(rq_hash)
+    if entry:
+      self.entries[rq_hash] = entry
+    return entry
+
+  def migrate_legacy(self, rq_hash):
+    # signing state used to be kept forever in the 'signable' KeyValue section
+    kv = KeyValue(self.db)
+    data = kv.get_by_section_key('signable', rq_hash)
+    if not data:
+      return None
+
+    entry = {
+      'rq_hash': rq_hash,
+      'pwtxid': data.get('pwtxid'),
+      'inputs': data['inputs'],
+      'req_sigs': data['req_sigs'],
+      'sigs_so_far': data['sigs_so_far'],
+      'requested_at': data.get('requested_at'),
+      'deadline': int(time.time() + SIGNING_TTL),
+      'done': 0,
+    }
+    SigningState(self.db).save(entry)
+    kv.delete('signable', rq_hash)
+    return entry
+
+  def update(self, rq_hash, sigs_so_far):
+    with self.lock:
+      entry = self.get_locked(rq_hash)
+      if not entry:
+        return
+      entry['sigs_so_far'] = sigs_so_far
+      if sigs_so_far >= entry['req_sigs'] and not entry['done']:
+        entry['done'] = 1
+        entry['deadline'] = min(entry['deadline'], int(time.time() + SIGNING_DONE_GRACE))
+      SigningState(self.db).update(entry)
+
+  def count(self):
+    with self.lock:
+      return len(self.entries)
+
+  def sweep(self, now=None):
+    """
+    Removes expired entries, returns how many
+    """
+    now = now or time.time()
+    states = SigningState(self.db)
+    variants = SignatureVariant(self.db)
+
+    expired = states.get_expired(now)
+    with self.lock:
+      for rq_hash in expired:
+        states.delete({'rq_hash': rq_hash})
+        variants.delete({'rq_hash': rq_hash})
+        self.entries.pop(rq_hash, None)
+      self.last_sweep = now
+
+    if expired:
+      logging.info('swept %r finished or expired signing entries' % len(expired))
+    return len(expired)
+
+  def sweep_if_due(self):
+    if time.time() - self.last_sweep >= SIGNING_SWEEP_INTERVAL:
+      self.sweep()
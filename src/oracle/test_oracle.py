@@ -0,0 +1,727 @@
+from __future__ import absolute_import
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from oracle.broadcaster import TransactionBroadcaster, HttpPushEndpoint, BitcoindPushEndpoint
+from oracle.oracle_db import (
+    OracleDb,
+    PendingBroadcast,
+    SignatureVariant,
+    SignLatency,
+    TaskQueue,
+    DeadTask,
+    TASK_MAX_ATTEMPTS,
+    TASK_RETRY_BASE_TIME,
+    TASK_RETRY_MAX_TIME)
+from oracle.signing_state import SigningIndex
+from oracle.mempool_watcher import MempoolWatcher
+from oracle.worker_pool import KeyedWorkerPool
+from oracle.handlers.bounty_contract.keypair_pool import KeypairPool
+from oracle.handlers.transactionsigner import TransactionSigner, TURN_LENGTH_TIME, TURN_DELAY_FLOOR
+from oracle.handlers.password_db import LockedPasswordTransaction, RSAKeyPairs
+from oracle.handlers.bounty_contract import guess_guard as guess_guard_module
+from oracle.handlers.bounty_contract.guess_guard import GuessGuard, GUESS_BURST, GUESS_RATE, REJECTED_PER_PWTXID
+from oracle.handlers.bounty_contract.bounty_redeem_handler import GuessPasswordHandler
+
+from shared.bitcoind_client.bitcoinclient import BitcoinClient
+from shared.bitcoind_client.rpcpool import RPCError
+from shared.bitcoind_client.rawtransaction import build_raw_transaction, parse_raw_transaction
+from shared.bitcoind_client.script import (
+    multisig_redeem_script,
+    parse_multisig_redeem_script,
+    pubkey_to_address,
+    script_to_p2sh_address)
+from shared.bitcoind_client.signatures import signature_state, merge_signatures
+from shared.test_shared import (
+    FAKE_TXID,
+    FAKE_PUBKEYS,
+    FAKE_SECRETS,
+    FAKE_RETURN_ADDRESS,
+    sign_multisig_input,
+    unsigned_multisig_spend)
+
+import BaseHTTPServer
+import hashlib
+import json
+import threading
+import time
+import unittest
+import urlparse
+
+TEMP_DB_FILE = 'temp_db_file.db'
+
+class MockOracleDb(OracleDb):
+  def __init__(self):
+    self._filename = TEMP_DB_FILE
+    self.connect()
+
+
+FAKE_SIGNED_TX = '0100000001' + '00' * 32 + 'ffffffff' + '00' + 'ffffffff' + '00' + '00000000'
+FAKE_SIGNED_TXID = hashlib.sha256(hashlib.sha256(FAKE_SIGNED_TX.decode('hex')).digest()).digest()[::-1].encode('hex')
+
+class StandInPushHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length'))
+    self.server.received.append(urlparse.parse_qs(self.rfile.read(length)))
+    self.send_response(self.server.status)
+    self.send_header('Content-Length', str(len(self.server.body)))
+    self.end_headers()
+    self.wfile.write(self.server.body)
+
+  def log_message(self, format, *args):
+    pass
+
+def start_push_endpoint(status, body=''):
+  server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInPushHandler)
+  server.status = status
+  server.body = body
+  server.received = []
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+class MockPushServer:
+  def __init__(self, error=None):
+    self.error = error
+    self.sent = []
+
+  def sendrawtransaction(self, tx):
+    self.sent.append(tx)
+    if self.error:
+      raise self.error
+    return hashlib.sha256(hashlib.sha256(tx.decode('hex')).digest()).digest()[::-1].encode('hex')
+
+class MockPushBitcoinClient:
+  def __init__(self, server):
+    self.blockchain_server = server
+
+class BroadcasterTests(unittest.TestCase):
+  def setUp(self):
+    self.db = MockOracleDb()
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+    os.remove(TEMP_DB_FILE)
+
+  def http_endpoint(self, status, body=None, accepted_marker=None):
+    if body is None:
+      # what a push service says when it accepts the transaction
+      body = 'Response = {}'.format(FAKE_SIGNED_TXID) if status == 200 else 'error'
+    server = start_push_endpoint(status, body)
+    self.servers.append(server)
+    url = 'http://127.0.0.1:{}/pushtx'.format(server.server_address[1])
+    return server, HttpPushEndpoint('stand-in-{}'.format(status), url, 'tx', accepted_marker=accepted_marker)
+
+  def test_first_accepting_endpoint_wins(self):
+    failing_server, failing = self.http_endpoint(500)
+    accepting_server, accepting = self.http_endpoint(200)
+    broadcaster = TransactionBroadcaster(self.db, [failing, accepting])
+
+    self.assertTrue(broadcaster.push_all(FAKE_SIGNED_TX))
+    self.assertEqual(accepting_server.received, [{'tx': [FAKE_SIGNED_TX]}])
+
+  def test_error_page_is_not_success(self):
+    rejecting_server, rejecting = self.http_endpoint(200, 'Error: transaction rejected')
+    broadcaster = TransactionBroadcaster(self.db, [rejecting])
+
+    self.assertFalse(broadcaster.push_all(FAKE_SIGNED_TX))
+    self.assertEqual(len(rejecting_server.received), 1)
+
+  def test_accepted_marker(self):
+    server, endpoint = self.http_endpoint(200, 'Transaction Submitted', 'Transaction Submitted')
+    self.assertTrue(endpoint.push(FAKE_SIGNED_TX))
+
+    server, endpoint = self.http_endpoint(200, 'Response = {}'.format(FAKE_SIGNED_TXID), 'Transaction Submitted')
+    self.assertFalse(endpoint.push(FAKE_SIGNED_TX))
+
+  def test_failed_push_is_retried(self):
+    failing_server, failing = self.http_endpoint(500)
+    broadcaster = TransactionBroadcaster(self.db, [failing])
+
+    broadcaster.enqueue(FAKE_SIGNED_TX)
+    pending = PendingBroadcast(self.db).get_due()
+    self.assertEqual(len(pending), 1)
+    broadcaster.broadcast(pending[0])
+
+    self.assertEqual(len(failing_server.received), 1)
+    # not due until the backoff passes, but still waiting
+    self.assertEqual(PendingBroadcast(self.db).get_due(), [])
+    rows = list(PendingBroadcast(self.db).iterate())
+    self.assertEqual(rows[0]['done'], 0)
+    self.assertEqual(rows[0]['attempts'], 1)
+    self.assertTrue(rows[0]['next_try'] > time.time())
+
+  def test_successful_push_is_done(self):
+    accepting_server, accepting = self.http_endpoint(200)
+    broadcaster = TransactionBroadcaster(self.db, [accepting])
+
+    broadcaster.enqueue(FAKE_SIGNED_TX)
+    broadcaster.broadcast(PendingBroadcast(self.db).get_due()[0])
+
+    rows = list(PendingBroadcast(self.db).iterate())
+    self.assertEqual(rows[0]['done'], PendingBroadcast.BROADCASTED)
+
+  def test_pending_broadcast_survives_restart(self):
+    TransactionBroadcaster(self.db, []).enqueue(FAKE_SIGNED_TX)
+
+    self.db = MockOracleDb()
+    pending = PendingBroadcast(self.db).get_due()
+    self.assertEqual([p['tx'] for p in pending], [FAKE_SIGNED_TX])
+
+  def test_bitcoind_accepting(self):
+    server = MockPushServer()
+    broadcaster = TransactionBroadcaster(self.db, [BitcoindPushEndpoint(MockPushBitcoinClient(server))])
+
+    self.assertTrue(broadcaster.push_all(FAKE_SIGNED_TX))
+    self.assertEqual(server.sent, [FAKE_SIGNED_TX])
+
+  def test_bitcoind_rejecting_is_not_success(self):
+    server = MockPushServer(RPCError('bitcoind', -25, 'Missing inputs'))
+    bitcoind = BitcoindPushEndpoint(MockPushBitcoinClient(server))
+    failing_server, failing = self.http_endpoint(500)
+    broadcaster = TransactionBroadcaster(self.db, [bitcoind, failing])
+
+    self.assertFalse(broadcaster.push_all(FAKE_SIGNED_TX))
+    self.assertEqual(server.sent, [FAKE_SIGNED_TX])
+
+class MockSignerBitcoinClient(BitcoinClient):
+  """
+  BitcoinClient without a node: the wallet holds FAKE_PRIVKEYS[mine]
+  """
+  def __init__(self, mine):
+    self.mine = mine
+    self.mine_cache = {}
+    self.signed = []
+
+  def rpc_address_is_mine(self, address):
+    return address == pubkey_to_address(FAKE_PUBKEYS[self.mine])
+
+  def is_valid_transaction(self, raw_transaction):
+    try:
+      parse_raw_transaction(raw_transaction)
+    except ValueError:
+      return False
+    return True
+
+  def get_inputs_outputs(self, raw_transaction):
+    tx = parse_raw_transaction(raw_transaction)
+    inputs = sorted(json.dumps({'txid': i['txid'], 'vout': i['vout']}) for i in tx['inputs'])
+    outputs = json.dumps([(o['value'], o['script'].encode('hex')) for o in tx['outputs']])
+    return inputs, outputs
+
+  def decode_script(self, script):
+    req_sigs, pubkeys = parse_multisig_redeem_script(script)
+    return {'addresses': [pubkey_to_address(pubkey) for pubkey in pubkeys]}
+
+  def sign_transaction(self, raw_transaction, prevtx=[], priv_keys=None):
+    self.signed.append(raw_transaction)
+    redeem_script = prevtx[0]['redeemScript']
+    return merge_signatures(raw_transaction, [
+        sign_multisig_input(raw_transaction, redeem_script, [FAKE_SECRETS[self.mine]])], prevtx)
+
+class MockBroadcaster:
+  def __init__(self):
+    self.enqueued = []
+
+  def enqueue(self, tx):
+    self.enqueued.append(tx)
+
+class MockSignerOracle:
+  def __init__(self, mine):
+    self.db = MockOracleDb()
+    self.btc = MockSignerBitcoinClient(mine)
+    self.signing = SigningIndex(self.db)
+    self.broadcaster = MockBroadcaster()
+    self.fastcast = []
+
+  def broadcast_with_fastcast(self, message):
+    self.fastcast.append(json.loads(message))
+
+class SignatureVariantTests(unittest.TestCase):
+  def setUp(self):
+    # this oracle holds the third key, the first two sign elsewhere
+    self.oracle = MockSignerOracle(2)
+    self.signer = TransactionSigner(self.oracle)
+
+    self.tx, self.prevtxs, self.redeem_script = unsigned_multisig_spend()
+    self.variants = [sign_multisig_input(self.tx, self.redeem_script, [secret]) for secret in FAKE_SECRETS]
+    self.rq_hash = self.signer.get_tx_hash(self.tx)
+    self.oracle.signing.create(self.rq_hash, 'pwtxid', self.prevtxs, 2)
+
+  def tearDown(self):
+    os.remove(TEMP_DB_FILE)
+
+  def stored(self):
+    return SignatureVariant(self.oracle.db).get_variants(self.rq_hash)
+
+  def test_merge_reaching_req_sigs_is_pushed(self):
+    self.signer.merge_variants(self.rq_hash, self.variants[0], self.prevtxs)
+    self.signer.sign_now(self.variants[1])
+
+    expected = merge_signatures(self.variants[0], [self.variants[1]], self.prevtxs)
+    self.assertEqual(self.oracle.broadcaster.enqueued, [expected])
+    # complete without our signature
+    self.assertEqual(self.oracle.btc.signed, [])
+
+  def test_own_signature_completing_is_pushed(self):
+    self.signer.sign_now(self.variants[0])
+
+    self.assertEqual(len(self.oracle.btc.signed), 1)
+    self.assertEqual(len(self.oracle.broadcaster.enqueued), 1)
+    pushed = self.oracle.broadcaster.enqueued[0]
+    self.assertEqual(signature_state(pushed, self.prevtxs)[0]['signed'], [FAKE_PUBKEYS[0], FAKE_PUBKEYS[2]])
+    self.assertEqual(self.oracle.fastcast[0]['transaction'], pushed)
+
+  def test_only_variants_with_new_signatures_are_stored(self):
+    first, second, third = self.variants
+
+    self.signer.merge_variants(self.rq_hash, self.tx, self.prevtxs)
+    self.assertEqual(self.stored(), [])
+
+    self.signer.merge_variants(self.rq_hash, first, self.prevtxs)
+    self.signer.merge_variants(self.rq_hash, first, self.prevtxs)
+    merged = self.signer.merge_variants(self.rq_hash, second, self.prevtxs)
+    self.assertEqual(self.stored(), [first, second])
+    self.assertEqual(merged, merge_signatures(first, [second], self.prevtxs))
+
+    # the same signature again, in a merged copy
+    self.signer.merge_variants(self.rq_hash, merged, self.prevtxs)
+    self.assertEqual(self.stored(), [first, second])
+
+  def test_junk_variants_are_not_stored(self):
+    first = self.variants[0]
+    self.signer.merge_variants(self.rq_hash, first, self.prevtxs)
+
+    other_tx, prevtxs, redeem_script = unsigned_multisig_spend(locktime=1402318623)
+    other = sign_multisig_input(other_tx, redeem_script, [FAKE_SECRETS[1]])
+    merged = self.signer.merge_variants(self.rq_hash, other, self.prevtxs)
+
+    self.assertEqual(self.stored(), [first])
+    self.assertEqual(merged, first)
+
+
+class TurnDelayTests(unittest.TestCase):
+  def setUp(self):
+    self.oracle = MockSignerOracle(2)
+    self.signer = TransactionSigner(self.oracle)
+    self.latency = SignLatency(self.oracle.db)
+
+  def tearDown(self):
+    os.remove(TEMP_DB_FILE)
+
+  def record(self, peer, sigs, latencies):
+    for latency in latencies:
+      self.latency.save({'peer': peer, 'sigs': sigs, 'latency': latency})
+
+  def test_first_turn_doesnt_wait(self):
+    self.record('fast', 0, [100] * 10)
+    self.assertEqual(self.signer.turn_delay(0), 0)
+
+  def test_fixed_turns_without_samples(self):
+    self.record('fast', 2, [30] * 3)
+    self.assertEqual(self.signer.turn_delay(1), TURN_LENGTH_TIME)
+    self.assertEqual(self.signer.turn_delay(2), 2 * TURN_LENGTH_TIME)
+
+  def test_waits_for_the_slowest_peer(self):
+    self.record('fast', 1, [20] * 20)
+    self.record('slow', 1, [20] * 5 + [120] * 5)
+    # too few samples to count
+    self.record('new', 1, [250] * 2)
+    self.assertEqual(self.signer.turn_delay(1), 120)
+
+  def test_delay_is_clamped(self):
+    self.record('fast', 1, [1] * 10)
+    self.assertEqual(self.signer.turn_delay(1), TURN_DELAY_FLOOR)
+
+class MockMempoolBitcoinClient:
+  def __init__(self, transactions, serves_mempool=True):
+    self.transactions = transactions
+    self.mempool = []
+    self.serves = serves_mempool
+    self.fetched = []
+    self.cached = []
+
+  def serves_mempool(self):
+    return self.serves
+
+  def get_raw_mempool(self):
+    if not self.serves:
+      raise AssertionError('no mempool to ask')
+    return list(self.mempool)
+
+  def get_mempool_transaction(self, txid):
+    self.fetched.append(txid)
+    return self.transactions[txid]
+
+  def cache_transaction(self, txid, raw_transaction):
+    self.cached.append(txid)
+    return {'txid': txid, 'hex': raw_transaction}
+
+class MockMempoolOracle:
+  def __init__(self, btc):
+    self.db = MockOracleDb()
+    self.btc = btc
+
+class MempoolWatcherTests(unittest.TestCase):
+  def setUp(self):
+    self.observed = script_to_p2sh_address(multisig_redeem_script(2, FAKE_PUBKEYS))
+    transactions = {
+      'ours': build_raw_transaction([{'txid': FAKE_TXID, 'vout': 0}], [(self.observed, 100000)]),
+      'other': build_raw_transaction([{'txid': FAKE_TXID, 'vout': 1}], [(FAKE_RETURN_ADDRESS, 100000)]),
+    }
+    self.btc = MockMempoolBitcoinClient(transactions)
+    self.watcher = MempoolWatcher(MockMempoolOracle(self.btc))
+
+  def tearDown(self):
+    if os.path.exists(TEMP_DB_FILE):
+      os.remove(TEMP_DB_FILE)
+
+  def test_first_snapshot_is_not_matched(self):
+    self.btc.mempool = ['ours']
+    self.assertEqual(self.watcher.poll([self.observed]), {})
+    self.assertEqual(self.btc.fetched, [])
+
+  def test_only_matching_transactions_are_cached(self):
+    self.watcher.poll([self.observed])
+    self.btc.mempool = ['ours', 'other']
+
+    matches = self.watcher.poll([self.observed, 'not an address'])
+    self.assertEqual(matches.keys(), [self.observed])
+    self.assertEqual([tx['txid'] for tx in matches[self.observed]], ['ours'])
+    self.assertEqual(sorted(self.btc.fetched), ['other', 'ours'])
+    self.assertEqual(self.btc.cached, ['ours'])
+
+    # already pending
+    self.btc.mempool = []
+    self.watcher.poll([self.observed])
+    self.btc.mempool = ['ours']
+    self.assertEqual(self.watcher.poll([self.observed]), {})
+
+  def test_no_polling_without_mempool(self):
+    self.btc.serves = False
+    watcher = MempoolWatcher(MockMempoolOracle(self.btc))
+    self.assertEqual(watcher.poll([self.observed]), {})
+    self.assertEqual(watcher.poll([self.observed]), {})
+
+
+
+class KeyedWorkerPoolTests(unittest.TestCase):
+  def setUp(self):
+    self.pool = KeyedWorkerPool(4)
+    self.lock = threading.Lock()
+    self.running = {}
+    self.max_running = {}
+    self.order = {}
+
+  def job(self, key, n):
+    with self.lock:
+      self.running[key] = self.running.get(key, 0) + 1
+      self.max_running[key] = max(self.max_running.get(key, 0), self.running[key])
+    time.sleep(0.002)
+    with self.lock:
+      self.running[key] -= 1
+      self.order.setdefault(key, []).append(n)
+
+  def test_same_key_runs_in_order_one_at_a_time(self):
+    for n in range(30):
+      for key in ['a', 'b', 'c']:
+        self.pool.submit(key, self.job, key, n)
+    self.pool.join()
+
+    for key in ['a', 'b', 'c']:
+      self.assertEqual(self.order[key], range(30))
+      self.assertEqual(self.max_running[key], 1)
+
+  def test_different_keys_run_concurrently(self):
+    started = threading.Event()
+    def first():
+      # finishes only if the other key's job runs meanwhile
+      self.assertTrue(started.wait(5))
+
+    first_job = self.pool.submit('a', first)
+    self.pool.submit('b', started.set)
+    self.assertTrue(first_job.wait())
+
+  def test_queue_depth_and_busy_keys(self):
+    release = threading.Event()
+    self.pool.submit('a', release.wait)
+    self.pool.submit('a', lambda: None)
+    self.pool.submit('b', release.wait)
+
+    self.assertEqual(self.pool.queue_depth(), 3)
+    self.assertEqual(self.pool.busy_keys(), 2)
+
+    release.set()
+    self.pool.join()
+    self.assertEqual(self.pool.queue_depth(), 0)
+    self.assertEqual(self.pool.busy_keys(), 0)
+
+  def test_failed_job_doesnt_stop_the_key(self):
+    def fail():
+      raise ValueError('boom')
+
+    failing = self.pool.submit('a', fail)
+    following = self.pool.submit('a', self.job, 'a', 1)
+
+    self.assertFalse(failing.wait())
+    self.assertTrue(following.wait())
+    self.assertEqual(self.order['a'], [1])
+
+
+
+def exit_at_once(size):
+  pass
+
+def keep_running(size):
+  time.sleep(60)
+
+class KeypairPoolTests(unittest.TestCase):
+  def test_dead_process_is_restarted(self):
+    pool = KeypairPool(target=exit_at_once)
+    pool.start()
+    first = pool.process
+    first.join(5)
+
+    self.assertFalse(pool.ensure_running())
+    self.assertFalse(pool.process is first)
+    pool.process.join(5)
+
+  def test_running_process_is_left_alone(self):
+    pool = KeypairPool(target=keep_running)
+    pool.start()
+    try:
+      process = pool.process
+      self.assertTrue(pool.ensure_running())
+      self.assertTrue(pool.process is process)
+    finally:
+      pool.process.terminate()
+
+
+
+class TaskQueueTests(unittest.TestCase):
+  def setUp(self):
+    self.db = MockOracleDb()
+    self.queue = TaskQueue(self.db)
+
+  def tearDown(self):
+    os.remove(TEMP_DB_FILE)
+
+  def add_task(self, next_check=0, dedup_key=None):
+    self.queue.save({
+      'operation': 'conditioned_transaction',
+      'json_data': json.dumps({'transaction': FAKE_SIGNED_TX}),
+      'next_check': next_check,
+      'done': 0,
+      'dedup_key': dedup_key,
+    })
+    return self.queue.get_all_ignore_checks()[-1]
+
+  def reload(self, task):
+    return list(self.queue.iterate(where='id=?', args=(task['id'], )))[0]
+
+  def test_retry_counts_attempts_and_backs_off(self):
+    task = self.add_task()
+    for attempt in range(1, TASK_MAX_ATTEMPTS):
+      before = int(time.time())
+      self.assertTrue(self.queue.retry(task))
+      task = self.reload(task)
+
+      delay = min(TASK_RETRY_BASE_TIME * 2 ** (attempt - 1), TASK_RETRY_MAX_TIME)
+      self.assertEqual(task['attempts'], attempt)
+      self.assertTrue(before + delay <= task['next_check'] <= int(time.time()) + delay)
+      self.assertEqual(task['done'], 0)
+
+    self.assertFalse(self.queue.retry(task))
+
+  def test_dead_lettered_after_max_attempts(self):
+    task = self.add_task()
+    for attempt in range(1, TASK_MAX_ATTEMPTS):
+      self.queue.failed(task, 'error %d' % attempt)
+      task = self.reload(task)
+      self.assertEqual(task['done'], 0)
+    self.assertEqual(DeadTask(self.db).get_all(), [])
+
+    self.queue.failed(task, 'error %d' % TASK_MAX_ATTEMPTS)
+    self.assertEqual(self.reload(task)['done'], 1)
+    self.assertEqual(self.queue.get_all_ignore_checks(), [])
+
+    dead = DeadTask(self.db).get_all()
+    self.assertEqual(len(dead), 1)
+    self.assertEqual(dead[0]['task_id'], task['id'])
+    self.assertEqual(dead[0]['operation'], task['operation'])
+    self.assertEqual(dead[0]['json_data'], task['json_data'])
+    self.assertEqual(dead[0]['attempts'], TASK_MAX_ATTEMPTS)
+    self.assertEqual(dead[0]['error'], 'error %d' % TASK_MAX_ATTEMPTS)
+
+
+  def test_duplicate_pending_task_is_merged(self):
+    first = self.add_task(next_check=1000, dedup_key='contract')
+    self.add_task(next_check=2000, dedup_key='contract')
+    self.assertEqual(self.queue.get_all_ignore_checks(), [first])
+
+    # an earlier duplicate moves the pending task forward
+    self.add_task(next_check=500, dedup_key='contract')
+    tasks = self.queue.get_all_ignore_checks()
+    self.assertEqual(len(tasks), 1)
+    self.assertEqual(tasks[0]['id'], first['id'])
+    self.assertEqual(tasks[0]['next_check'], 500)
+
+  def test_done_task_is_not_merged_into(self):
+    first = self.add_task(dedup_key='contract')
+    self.queue.done(first)
+    second = self.add_task(dedup_key='contract')
+    self.assertNotEqual(second['id'], first['id'])
+
+  def test_tasks_without_dedup_key_are_kept(self):
+    self.add_task()
+    self.add_task()
+    self.add_task(dedup_key='contract')
+    self.add_task(dedup_key='other contract')
+    self.assertEqual(len(self.queue.get_all_ignore_checks()), 4)
+
+
+
+class PasswordDbTests(unittest.TestCase):
+  def setUp(self):
+    self.db = MockOracleDb()
+
+  def tearDown(self):
+    os.remove(TEMP_DB_FILE)
+
+  def test_password_hash_of_legacy_rows_is_backfilled(self):
+    # a bounty saved before the password_hash column was added
+    self.db.execute("create table locked_bounty_create ( \
+        id integer primary key autoincrement, \
+        ts datetime default current_timestamp, \
+        pwtxid text unique, \
+        json_data text not null, \
+        done integer default 0)")
+    self.db.conn.execute("insert into locked_bounty_create (pwtxid, json_data) values (?, ?)",
+        ('legacy', json.dumps({'password_hash': 'abc123'})))
+    self.db.commit()
+
+    locked = LockedPasswordTransaction(self.db)
+    self.assertEqual(locked.get_by_pwtxid('legacy')['password_hash'], None)
+    self.assertEqual(locked.get_password_hash('legacy'), 'abc123')
+    self.assertEqual(locked.get_by_pwtxid('legacy')['password_hash'], 'abc123')
+
+  def test_password_hash(self):
+    locked = LockedPasswordTransaction(self.db)
+    locked.save({'pwtxid': 'new', 'json_data': json.dumps({}), 'password_hash': 'def456'})
+    locked.save({'pwtxid': 'without hash', 'json_data': json.dumps({})})
+
+    self.assertEqual(locked.get_password_hash('new'), 'def456')
+    self.assertEqual(locked.get_password_hash('without hash'), None)
+    self.assertEqual(locked.get_password_hash('missing'), None)
+
+  def test_keypair_is_claimed_once(self):
+    keypairs = RSAKeyPairs(self.db)
+    for n in range(5):
+      keypairs.save({'pwtxid': None, 'public': 'public %d' % n, 'whole': 'whole %d' % n})
+
+    claimed = {}
+    def claim(pwtxid):
+      claimed[pwtxid] = keypairs.claim(pwtxid)
+    threads = [threading.Thread(target=claim, args=('pwtxid %d' % n, )) for n in range(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    keys = [key for key in claimed.values() if key]
+    self.assertEqual(len(claimed), 10)
+    self.assertEqual(len(keys), 5)
+    self.assertEqual(len(set(key['id'] for key in keys)), 5)
+    for pwtxid, key in claimed.items():
+      if key:
+        self.assertEqual(key['pwtxid'], pwtxid)
+    self.assertEqual(keypairs.available_count(), 0)
+
+
+
+class MockBountyOracle:
+  def __init__(self, db):
+    self.db = db
+    self.btc = None
+    self.task_queue = TaskQueue(db)
+
+class GuessGuardTests(unittest.TestCase):
+  def setUp(self):
+    self.guard = GuessGuard()
+
+  def test_sources_are_rate_limited_separately(self):
+    for i in range(GUESS_BURST):
+      self.assertTrue(self.guard.allow_source('spammer'))
+    self.assertFalse(self.guard.allow_source('spammer'))
+    self.assertTrue(self.guard.allow_source('someone else'))
+
+  def test_source_bucket_refills(self):
+    for i in range(GUESS_BURST):
+      self.guard.allow_source('spammer')
+    self.assertFalse(self.guard.allow_source('spammer'))
+
+    # pretend a guess interval has passed
+    self.guard.buckets['spammer'].last -= 1.0 / GUESS_RATE
+    self.assertTrue(self.guard.allow_source('spammer'))
+    self.assertFalse(self.guard.allow_source('spammer'))
+
+  def test_rejected_guess_is_remembered(self):
+    self.guard.reject('pwtxid', 'ciphertext')
+    self.assertTrue(self.guard.was_rejected('pwtxid', 'ciphertext'))
+    self.assertFalse(self.guard.was_rejected('pwtxid', 'other ciphertext'))
+    self.assertFalse(self.guard.was_rejected('other pwtxid', 'ciphertext'))
+
+  def test_rejected_guess_expires(self):
+    self.guard.reject('pwtxid', 'ciphertext')
+    self.guard.rejected['pwtxid'][self.guard.guess_hash('ciphertext')] = time.time() - 1
+    self.assertFalse(self.guard.was_rejected('pwtxid', 'ciphertext'))
+    self.assertEqual(len(self.guard.rejected['pwtxid']), 0)
+
+  def test_rejected_guesses_are_capped_per_pwtxid(self):
+    for n in range(REJECTED_PER_PWTXID + 1):
+      self.guard.reject('pwtxid', 'ciphertext %d' % n)
+    self.assertEqual(len(self.guard.rejected['pwtxid']), REJECTED_PER_PWTXID)
+    self.assertFalse(self.guard.was_rejected('pwtxid', 'ciphertext 0'))
+    self.assertTrue(self.guard.was_rejected('pwtxid', 'ciphertext %d' % REJECTED_PER_PWTXID))
+
+  def test_forget(self):
+    self.guard.reject('pwtxid', 'ciphertext')
+    self.guard.reject('other pwtxid', 'ciphertext')
+    self.guard.forget('pwtxid')
+    self.assertFalse(self.guard.was_rejected('pwtxid', 'ciphertext'))
+    self.assertTrue(self.guard.was_rejected('other pwtxid', 'ciphertext'))
+
+  def test_redeem_forgets_rejected_guesses(self):
+    db = MockOracleDb()
+    self.addCleanup(os.remove, TEMP_DB_FILE)
+    oracle = MockBountyOracle(db)
+
+    # already redeemed by an earlier guess, so nothing is signed
+    locked = LockedPasswordTransaction(db)
+    locked.save({'pwtxid': 'pwtxid', 'json_data': json.dumps({}), 'password_hash': 'abc123'})
+    locked.mark_as_done('pwtxid')
+    oracle.task_queue.save({
+      'operation': 'bounty_redeem',
+      'json_data': json.dumps({'pwtxid': 'pwtxid', 'guess': 'right ciphertext', 'address': FAKE_RETURN_ADDRESS}),
+      'next_check': 0,
+      'done': 0,
+    })
+    task = oracle.task_queue.get_all_ignore_checks()[0]
+
+    guard = guess_guard_module.guess_guard
+    guard.reject('pwtxid', 'wrong ciphertext')
+    self.addCleanup(guard.forget, 'pwtxid')
+
+    GuessPasswordHandler(oracle).handle_task(task)
+    self.assertFalse(guard.was_rejected('pwtxid', 'wrong ciphertext'))
+    self.assertEqual(oracle.task_queue.get_all_ignore_checks(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
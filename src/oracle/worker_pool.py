@@ -0,0 +1,103 @@
+from collections import deque
+
+import logging
+import threading
+import Queue
+
+WORKER_POOL_SIZE = 4
+
+class Job:
+  def __init__(self, fun, args, kwargs):
+    self.fun = fun
+    self.args = args
+    self.kwargs = kwargs
+    self.done = threading.Event()
+    self.failed = False
+
+  def wait(self):
+    """
+    Blocks until the job ran, returns False if it raised
+    """
+    # with a timeout, so the wait can be interrupted
+    while not self.done.wait(1):
+      pass
+    return not self.failed
+
+class KeyedWorkerPool:
+  """
+  Runs handler work on a pool of threads. Jobs submitted with the same key
+  (pwtxid, contract_id, mark address...) run one after another in the order
+  they were submitted, jobs with different keys run concurrently.
+  """
+  def __init__(self, size=WORKER_POOL_SIZE):
+    self.size = size
+    self.lock = threading.Lock()
+    self.idle = threading.Condition(self.lock)
+
+    # key -> deque of jobs waiting for that key, the first one is running
+    self.pending = {}
+    self.ready_keys = Queue.Queue()
+
+    self.workers = []
+    for i in range(size):
+      worker = threading.Thread(target=self.work, name='worker-{}'.format(i))
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def submit(self, key, fun, *args, **kwargs):
+    """
+    Returns the Job, to wait for it
+    """
+    job = Job(fun, args, kwargs)
+    with self.lock:
+      if key in self.pending:
+        # some job for this key is already queued or running, keep the order
+        self.pending[key].append(job)
+        return job
+      self.pending[key] = deque([job])
+    self.ready_keys.put(key)
+    return job
+
+  def work(self):
+    while True:
+      key = self.ready_keys.get()
+
+      with self.lock:
+        job = self.pending[key][0]
+
+      try:
+        job.fun(*job.args, **job.kwargs)
+      except:
+        job.failed = True
+        logging.exception('worker job for key %r failed' % (key, ))
+      job.done.set()
+
+      with self.lock:
+        jobs = self.pending[key]
+        jobs.popleft()
+        if jobs:
+          self.ready_keys.put(key)
+        else:
+          del self.pending[key]
+          if not self.pending:
+            self.idle.notify_all()
+
+  def queue_depth(self):
+    """
+    Number of jobs that are waiting or running
+    """
+    with self.lock:
+      return sum(len(jobs) for jobs in self.pending.itervalues())
+
+  def busy_keys(self):
+    with self.lock:
+      return len(self.pending)
+
+  def join(self):
+    """
+    Blocks until every submitted job is finished
+    """
+    with self.lock:
+      while self.pending:
+        self.idle.wait(1)
@@ -2,9 +2,16 @@
 from shared import logger
 from oracle.oracle import Oracle
 
+import argparse
+
 def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--start-height', type=int, default=None,
+      help='first block to scan when the database is fresh (default: newest confirmed block)')
+  args = parser.parse_args()
+
   logger.init_logger()
-  o = Oracle()
+  o = Oracle(start_height=args.start_height)
   o.run()
 
 if __name__=="__main__":
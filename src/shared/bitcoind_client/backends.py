@@ -0,0 +1,108 @@
+from rpcpool import RPCPool
+from xmlrpclib import ProtocolError
+
+import httplib
+import logging
+import socket
+import threading
+import time
+
+# a failing backend is skipped for 5s, 10s, 20s... but no longer than 5 minutes
+BACKEND_RETRY_BASE_TIME = 5
+BACKEND_RETRY_MAX_TIME = 5 * 60
+# weight of the newest call in the average latency
+LATENCY_SMOOTHING = 0.2
+
+class NoBackendError(Exception):
+  pass
+
+class ReadBackend:
+  def __init__(self, url):
+    self.url = url
+    self.server = RPCPool(url)
+    self.failures = 0
+    self.down_until = 0
+    self.in_flight = 0
+    # seconds, optimistic until measured
+    self.latency = 0.0
+
+  def name(self):
+    # without the credentials
+    return self.url.rsplit('@', 1)[-1]
+
+  def healthy(self, now):
+    return self.down_until <= now
+
+  def load(self):
+    return (self.in_flight + 1) * max(self.latency, 0.001)
+
+
+class ReadBalancer:
+  """
+  Spreads stateless read-only RPCs (getrawtransaction, decoderawtransaction...)
+  over several bitcoind nodes. Every call goes to the healthy backend with the
+  least in-flight work weighted by its average latency; backends that fail
+  to answer are skipped with exponential backoff.
+  """
+  def __init__(self, urls):
+    self.backends = [ReadBackend(url) for url in urls]
+    self.lock = threading.Lock()
+
+  def pick(self, tried):
+    now = time.time()
+    with self.lock:
+      candidates = [b for b in self.backends if not b in tried and b.healthy(now)]
+      if not candidates:
+        return None
+      backend = min(candidates, key=lambda b: b.load())
+      backend.in_flight += 1
+      return backend
+
+  def succeeded(self, backend, elapsed):
+    with self.lock:
+      backend.in_flight -= 1
+      backend.failures = 0
+      backend.latency += LATENCY_SMOOTHING * (elapsed - backend.latency)
+
+  def failed(self, backend):
+    with self.lock:
+      backend.in_flight -= 1
+      backend.failures += 1
+      delay = min(BACKEND_RETRY_BASE_TIME * 2 ** (backend.failures - 1), BACKEND_RETRY_MAX_TIME)
+      backend.down_until = time.time() + delay
+    logging.warning('read backend %s failed %d times, skipping it for %ds' % (backend.name(), backend.failures, delay))
+
+  def call(self, method, *args):
+    """
+    Raises NoBackendError when none of the backends could answer
+    """
+    tried = set()
+    while True:
+      backend = self.pick(tried)
+      if backend is None:
+        raise NoBackendError(method)
+      tried.add(backend)
+
+      start = time.time()
+      answered = False
+      try:
+        result = getattr(backend.server, method)(*args)
+        answered = True
+        return result
+      except ProtocolError:
+        # bitcoind answered with an error (e.g. unknown txid), the node is fine
+        answered = True
+        raise
+      except (socket.error, httplib.HTTPException):
+        pass
+      finally:
+        if answered:
+          self.succeeded(backend, time.time() - start)
+        else:
+          self.failed(backend)
+      # couldn't reach the backend, try the next one
+
+  def healthy_count(self):
+    now = time.time()
+    with self.lock:
+      return len([b for b in self.backends if b.healthy(now)])
@@ -13,31 +13,85 @@ from settings_local import (
     ORACLE_FEE,
     ORGANIZATION_FEE
 )
+try:
+  from settings_local import BITCOIND_READ_BACKENDS
+except ImportError:
+  BITCOIND_READ_BACKENDS = []
 from shared.liburl_wrapper import safe_blockchain_multiaddress, safe_nonbitcoind_blockchain_getblock, safe_get_raw_transaction
+from shared.ratelimit import TokenBucket
+from shared.tx_cache import TransactionCache
 
 import json
-import jsonrpclib
-from bitcoinrpc.authproxy import AuthServiceProxy
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+from rpcpool import RPCPool
+from singleflight import SingleFlight
+from backends import ReadBalancer, NoBackendError
+from script import multisig_redeem_script, script_to_p2sh_address, pubkey_to_address, InvalidPubkeyError
+from signatures import signature_state as local_signature_state, merge_signatures, add_signatures
 import time
 from xmlrpclib import ProtocolError
-from decimal import Decimal
-import socket
+from shared.satoshi import Satoshi
 
 import logging
 logging.getLogger("requests").setLevel(logging.CRITICAL)
 
 TEST_MODE = BITCOIND_TEST_MODE
 
-class UnknownServerError(Exception):
-  pass
+# blockchain.info (used in TEST_MODE) limits how often we can query it
+MULTIADDRESS_CHUNK = 5
+BLOCKCHAIN_PARALLELISM = 4
+BLOCKCHAIN_REQUESTS_PER_SECOND = 1
+BLOCKCHAIN_REQUESTS_BURST = 5
+
+blockchain_rate_limit = TokenBucket(BLOCKCHAIN_REQUESTS_PER_SECOND, BLOCKCHAIN_REQUESTS_BURST)
 
 def slice_list(list, chunk):
   return [list[i*chunk:(i+1)*chunk] for i in range(0, int((len(list)+chunk)/chunk))]
 
+def add_spent_outputs(transaction, spent_outputs):
+  for vin in transaction['vin']:
+    # coinbase inputs don't spend anything
+    if 'txid' in vin:
+      spent_outputs.add((vin['txid'], vin['vout']))
+
+def single_flight(fun):
+  """
+  Concurrent calls with the same arguments share one request
+  """
+  def coalesced(self, *args):
+    return self.single_flight.do((fun.__name__, ) + args, fun, self, *args)
+  coalesced.__name__ = fun.__name__
+  return coalesced
+
 class BitcoinClient:
 
   def __init__(self, account=None):
     self.account = account
+
+    # (req_sigs, sorted pubkeys) -> {'address':..., 'redeemScript':...}
+    self.multisig_cache = {}
+    self.imported_addresses = set()
+    self.import_queue = Queue.Queue()
+    self.import_thread = None
+    self.multisig_lock = threading.Lock()
+
+    # height of the chain tip, refreshed once per oracle cycle
+    self.tip_height = None
+
+    self.tx_cache = TransactionCache()
+    self.single_flight = SingleFlight()
+
+    # addresses known to be ours; keys can be imported while running,
+    # so "not mine" is never cached
+    self.mine_cache = {}
+
+    # extra nodes for read-only calls, wallet calls always go to self.server
+    self.read_balancer = None
+    if BITCOIND_READ_BACKENDS and not TEST_MODE:
+      self.read_balancer = ReadBalancer(BITCOIND_READ_BACKENDS)
+
     self.connect()
     self.blockchain_connect()
 
@@ -60,12 +114,11 @@ class BitcoinClient:
 
   def connect(self):
     def server_connection():
-      self.server = jsonrpclib.Server('http://{0}:{1}@{2}:{3}'.format(
+      self.server = RPCPool('http://{0}:{1}@{2}:{3}'.format(
           BITCOIND_RPC_USERNAME,
           BITCOIND_RPC_PASSWORD,
           BITCOIND_RPC_HOST,
           BITCOIND_RPC_PORT))
-      socket.setdefaulttimeout(None)
       self.server.help()
     self._connect(server_connection)
 
@@ -75,53 +128,42 @@ class BitcoinClient:
     """
     def server_connection():
       if TEST_MODE:
-        self.blockchain_server = jsonrpclib.Server('http://{0}:{1}@{2}:{3}'.format(
+        self.blockchain_server = RPCPool('http://{0}:{1}@{2}:{3}'.format(
             BITCOIND_TEST_RPC_USERNAME,
             BITCOIND_TEST_RPC_PASSWORD,
             BITCOIND_TEST_RPC_HOST,
             BITCOIND_TEST_RPC_PORT))
       else:
-        self.blockchain_server = jsonrpclib.Server('http://{0}:{1}@{2}:{3}'.format(
+        self.blockchain_server = RPCPool('http://{0}:{1}@{2}:{3}'.format(
             BITCOIND_RPC_USERNAME,
             BITCOIND_RPC_PASSWORD,
             BITCOIND_RPC_HOST,
             BITCOIND_RPC_PORT))
-      socket.setdefaulttimeout(None)
       self.server.help()
     self._connect(server_connection)
 
 
-  def keep_alive(server):
-    def wrapper(fun):
-      def ping_and_reconnect(self, *args, **kwargs):
-        if server == 'server':
-          server_instance = self.server
-          connection_function = self.connect
-        elif server == 'blockchain_server':
-          return fun(self, *args, **kwargs)
-        else:
-          raise UnknownServerError()
+  def read(self, server, method, *args):
+    """
+    Read-only RPC, spread over the read backends when there are any.
+    When all of them are down it falls back to the given server.
+    Only for calls whose answer doesn't depend on the node's view of the
+    chain -- tip, blocks and mempool are always asked from blockchain_server.
+    """
+    if self.read_balancer:
+      try:
+        return self.read_balancer.call(method, *args)
+      except NoBackendError:
+        logging.warning('no read backend available for %s, using the primary node' % method)
+    return getattr(server, method)(*args)
 
-        try:
-          # Cheap API call that checks wether we're connected
-          server_instance.help()
-          response = fun(self, *args, **kwargs)
-          return response
-        except:
-          connection_function()
-        return fun(self, *args, **kwargs)
-      return ping_and_reconnect
-    return wrapper
-
-  @keep_alive('server')
+  @single_flight
   def decode_raw_transaction(self, hex_transaction):
-    return self.server.decoderawtransaction(hex_transaction)
+    return self.read(self.server, 'decoderawtransaction', hex_transaction)
 
-  @keep_alive('server')
   def get_json_transaction(self, hex_transaction):
-    return self.server.decoderawtransaction(hex_transaction)
+    return self.read(self.server, 'decoderawtransaction', hex_transaction)
 
-  @keep_alive('server')
   def sign_transaction(self, raw_transaction, prevtx = [], priv_keys=None):
     if priv_keys:
       result = self.server.signrawtransaction(raw_transaction, prevtx, priv_keys)
@@ -129,49 +171,41 @@ class BitcoinClient:
       result = self.server.signrawtransaction(raw_transaction, prevtx)
     return result['hex']
 
-  @keep_alive('server')
   def get_txid(self, raw_transaction):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.read(self.server, 'decoderawtransaction', raw_transaction)
     return transaction_dict['txid']
 
-  @keep_alive('server')
-  def signatures_count(self, raw_transaction, prevtx):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
-
-    prevtx_dict = {}
-    for tx in prevtx:
-      prevtx_dict["{}#{}".format(tx['txid'], tx['vout'])] = tx['redeemScript']
+  def signature_state(self, raw_transaction, prevtx):
+    """
+    Per input: pubkeys of the redeem script that already signed, and
+    the ones that belong to this wallet. Checked locally, no signing involved.
+    """
+    state = local_signature_state(raw_transaction, prevtx)
+    for tx_input in state:
+      tx_input['mine'] = [pubkey for pubkey in tx_input['pubkeys']
+          if self.address_is_mine(pubkey_to_address(pubkey))]
+    return state
 
-    has_signatures = 999
-    for vin in transaction_dict['vin']:
-      redeem_script = prevtx_dict["{}#{}".format(tx['txid'], tx['vout'])]
-      try:
-        asm = vin['scriptSig']['asm']
-      except KeyError:
-        logging.error('transaction doesn\'t have scriptSig asm')
-        continue
-      asm_elements = asm.split()
-      try:
-        asm_script_dict = self.server.decodescript(redeem_script)
-        int(asm_script_dict['reqSigs'])
-      except KeyError:
-        logging.error('script is missing reqSigs field')
-        continue
-      # first elements is op_zero, last is script, rest is signatuers
-      asm_signatures = asm_elements[1:-1]
+  def merge_signatures(self, raw_transaction, variants, prevtx):
+    """
+    raw_transaction with the signatures of all the variants added
+    """
+    return merge_signatures(raw_transaction, variants, prevtx)
 
-      # if tried to sign a tx with the same signature again, the sig will equal '0', and we should ignore it
-      current_signatures = 0
-      for a in asm_signatures:
-        if a != '0':
-          current_signatures += 1
-      has_signatures = min(has_signatures, current_signatures)
-    return has_signatures
+  def add_signatures(self, raw_transaction, variant, prevtx):
+    """
+    (raw_transaction with the signatures of variant added, how many were new)
+    """
+    return add_signatures(raw_transaction, variant, prevtx)
 
+  def signatures_count(self, raw_transaction, prevtx):
+    state = local_signature_state(raw_transaction, prevtx)
+    if not state:
+      return 0
+    return min(len(tx_input['signed']) for tx_input in state)
 
-  @keep_alive('server')
   def signatures(self, raw_transaction, prevtx):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.read(self.server, 'decoderawtransaction', raw_transaction)
 
     prevtx_dict = {}
     for tx in prevtx:
@@ -187,7 +221,7 @@ class BitcoinClient:
         continue
       asm_elements = asm.split()
       try:
-        asm_script_dict = self.server.decodescript(redeem_script)
+        asm_script_dict = self.read(self.server, 'decodescript', redeem_script)
         int(asm_script_dict['reqSigs'])
       except KeyError:
         logging.error('script is missing reqSigs field')
@@ -199,28 +233,33 @@ class BitcoinClient:
       has_signatures = min(has_signatures, current_signatures)
     return has_signatures
 
-  @keep_alive('server')
   def is_valid_transaction(self, raw_transaction):
     # Is raw transaction valid and decodable?
     try:
-      self.server.decoderawtransaction(raw_transaction)
+      self.read(self.server, 'decoderawtransaction', raw_transaction)
     except ProtocolError:
       logging.exception('tx invalid')
       return False
     return True
 
-  @keep_alive('server')
   def address_is_mine(self, address):
+    if address in self.mine_cache:
+      return True
+    if self.rpc_address_is_mine(address):
+      self.mine_cache[address] = True
+      return True
+    return False
+
+  def rpc_address_is_mine(self, address):
     result = self.server.validateaddress(address)
     return result['ismine']
 
-  @keep_alive('server')
+  @single_flight
   def decode_script(self, script):
-    return self.server.decodescript(script)
+    return self.read(self.server, 'decodescript', script)
 
-  @keep_alive('server')
   def get_inputs_outputs(self, raw_transaction):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.read(self.server, 'decoderawtransaction', raw_transaction)
     vin = transaction_dict["vin"]
     vouts = transaction_dict["vout"]
     result = (
@@ -239,14 +278,15 @@ class BitcoinClient:
 
     return result
 
-  @keep_alive('server')
   def transaction_already_signed(self, raw_transaction, prevtx):
-    signed_transaction = self.sign_transaction(raw_transaction, prevtx)
-    if signed_transaction == raw_transaction:
-      return True
-    return False
+    """
+    True when our keys already signed every input we can sign
+    """
+    for tx_input in self.signature_state(raw_transaction, prevtx):
+      if tx_input['mine'] and not set(tx_input['mine']) & set(tx_input['signed']):
+        return False
+    return True
 
-  @keep_alive('server')
   def transaction_need_signature(self, raw_transaction):
     """
     This is shameful ugly function. It tries to send transaction to network
@@ -259,9 +299,8 @@ class BitcoinClient:
     except ProtocolError:
       return True
 
-  @keep_alive('server')
   def transaction_contains_output(self, raw_transaction, address, fee):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.read(self.server, 'decoderawtransaction', raw_transaction)
     if not 'vout' in transaction_dict:
       return False
     for vout in transaction_dict['vout']:
@@ -275,59 +314,101 @@ class BitcoinClient:
 
       for address in vout['scriptPubKey']['addresses']:
         if address == address:
-          value = Decimal(vout['value'])
-          if value >= Decimal(fee):
+          value = Satoshi.from_btc(vout['value'])
+          if value >= Satoshi.from_btc(fee):
             return True
     return False
 
-  @keep_alive('server')
   def transaction_contains_oracle_fee(self, raw_transaction):
     return self.transaction_contains_output(raw_transaction, ORACLE_ADDRESS, ORACLE_FEE)
 
-  @keep_alive('server')
   def transaction_contains_org_fee(self, raw_transaction):
     return self.transaction_contains_output(raw_transaction, ORGANIZATION_ADDRESS, ORGANIZATION_FEE)
 
-  @keep_alive('server')
   def create_multisig_address(self, min_sigs, keys):
+    """
+    The result depends only on the keys, so it's derived locally and memoized
+    """
     keys = sorted(keys)
+    cache_key = (int(min_sigs), tuple(keys))
+
+    with self.multisig_lock:
+      multisig = self.multisig_cache.get(cache_key)
+    if multisig:
+      return multisig
+
+    try:
+      redeem_script = multisig_redeem_script(int(min_sigs), keys)
+      multisig = {
+          'address': script_to_p2sh_address(redeem_script),
+          'redeemScript': redeem_script}
+    except InvalidPubkeyError:
+      # e.g. wallet addresses instead of pubkeys - only bitcoind can resolve those
+      multisig = self.rpc_create_multisig_address(min_sigs, keys)
+
+    with self.multisig_lock:
+      self.multisig_cache[cache_key] = multisig
+    return multisig
+
+  def rpc_create_multisig_address(self, min_sigs, keys):
     return self.server.createmultisig(min_sigs, keys)
 
-  @keep_alive('server')
   def add_multisig_address(self, min_sigs, keys):
-    keys = sorted(keys)
+    """
+    Returns the multisig address; it's imported to the wallet in the background
+    """
+    self.import_multisig_address(min_sigs, keys)
+    return self.create_multisig_address(min_sigs, keys)['address']
+
+  def import_multisig_address(self, min_sigs, keys):
+    address = self.create_multisig_address(min_sigs, keys)['address']
+
+    with self.multisig_lock:
+      if address in self.imported_addresses:
+        return
+      self.imported_addresses.add(address)
+
+      if self.import_thread is None:
+        self.import_thread = threading.Thread(target=self.import_worker, name='multisig-import')
+        self.import_thread.daemon = True
+        self.import_thread.start()
+
+    self.import_queue.put((min_sigs, sorted(keys), address))
+
+  def import_worker(self):
+    while True:
+      min_sigs, keys, address = self.import_queue.get()
+      try:
+        self.rpc_add_multisig_address(min_sigs, keys)
+      except:
+        logging.exception('failed importing multisig address %r' % address)
+        with self.multisig_lock:
+          self.imported_addresses.discard(address)
+
+  def rpc_add_multisig_address(self, min_sigs, keys):
     if self.account:
       return self.server.addmultisigaddress(min_sigs, keys, self.account)
     return self.server.addmultisigaddress(min_sigs, keys)
 
-  @keep_alive('server')
-  def create_raw_transaction(self, tx_inputs, outputs):
-    return self.server.createrawtransaction(tx_inputs, outputs)
-
-  @keep_alive('server')
   def get_new_address(self):
     if self.account:
       return self.server.getnewaddress(self.account)
     return self.server.getnewaddress()
 
-  @keep_alive('server')
   def get_addresses_for_account(self, account):
     all_addresses = self.server.listreceivedbyaddress(0,True)
     addresses = [elt['address'] for elt in all_addresses if elt['account'] == account]
     return addresses
 
-  @keep_alive('server')
   def validate_address(self, address):
     return self.server.validateaddress(address)
 
-  @keep_alive('blockchain_server')
   def get_block_hash(self, block_number):
     try:
       return self.blockchain_server.getblockhash(block_number)
     except:
       return None
 
-  @keep_alive('blockchain_server')
   def bitcoind_get_block(self, block_hash):
     return self.blockchain_server.getblock(block_hash)
 
@@ -338,8 +419,6 @@ class BitcoinClient:
       # Temporary solution before blockchain.info will fix their API
       not_proper_data = safe_nonbitcoind_blockchain_getblock(block_hash)
 
-      max_height = self.blockchain_server.getblockcount()
-
       proper_data = {}
       try:
         proper_data['hash'] = not_proper_data['hash']
@@ -349,7 +428,7 @@ class BitcoinClient:
       proper_data['height'] = not_proper_data['height']
       proper_data['size'] = not_proper_data['size']
       proper_data['merkleroot'] = not_proper_data['mrkl_root']
-      proper_data['confirmations'] = max_height - proper_data['height'] + 1
+      proper_data['confirmations'] = self.confirmations(proper_data['height'])
       proper_data['version'] = not_proper_data['ver']
       proper_data['time'] = not_proper_data['time']
       proper_data['nonce'] = not_proper_data['nonce']
@@ -358,11 +437,24 @@ class BitcoinClient:
       proper_data['tx'] = [tx['hash'] for tx in not_proper_data['tx']]
       return proper_data
 
-  @keep_alive('blockchain_server')
   def get_block_count(self):
     return self.blockchain_server.getblockcount()
 
-  @keep_alive('blockchain_server')
+  def refresh_tip(self):
+    self.tip_height = self.get_block_count()
+    return self.tip_height
+
+  def get_tip_height(self):
+    if self.tip_height is None:
+      return self.refresh_tip()
+    return self.tip_height
+
+  def confirmations(self, height):
+    """
+    Confirmations of the block at height, computed from the cached tip
+    """
+    return self.get_tip_height() - height + 1
+
   def send_transaction(self, tx):
     try:
       if not TEST_MODE:
@@ -371,48 +463,135 @@ class BitcoinClient:
     except ProtocolError:
       return False
 
+  @single_flight
   def get_raw_transaction(self, txid):
+    raw_transaction = self.tx_cache.get_raw(txid)
+    if raw_transaction:
+      return raw_transaction
+
     if not TEST_MODE:
-      return self.server.getrawtransaction(txid)
+      try:
+        raw_transaction = self.read(self.server, 'getrawtransaction', txid)
+      except ProtocolError:
+        if not self.read_balancer:
+          raise
+        # a lagging backend may not know transactions of the newest block yet
+        raw_transaction = self.server.getrawtransaction(txid)
     else:
-      return safe_get_raw_transaction(txid)
+      raw_transaction = safe_get_raw_transaction(txid)
+
+    if raw_transaction:
+      self.tx_cache.put_raw(txid, raw_transaction)
+    return raw_transaction
+
+  def get_decoded_transaction(self, txid, raw_transaction=None):
+    """
+    Decoded transaction by txid, raw_transaction saves the fetch if it's already known
+    """
+    transaction = self.tx_cache.get_decoded(txid)
+    if transaction:
+      return transaction
+
+    if not raw_transaction:
+      raw_transaction = self.get_raw_transaction(txid)
+    if not raw_transaction:
+      return None
+
+    transaction = self.decode_raw_transaction(raw_transaction)
+    self.tx_cache.put_decoded(txid, transaction)
+    return transaction
+
+  def serves_mempool(self):
+    # in TEST_MODE the chain comes from blockchain.info, which has no getrawmempool
+    return not TEST_MODE
+
+  def get_raw_mempool(self):
+    return self.blockchain_server.getrawmempool()
 
-  def get_transactions_from_block(self, block, addresses):
+  def get_mempool_transaction(self, txid):
+    """
+    Raw transaction from blockchain_server's mempool, not cached --
+    most of them are of no interest
+    """
+    return self.blockchain_server.getrawtransaction(txid)
+
+  def cache_transaction(self, txid, raw_transaction):
+    """
+    Keeps a transaction fetched elsewhere, returns it decoded
+    """
+    self.tx_cache.put_raw(txid, raw_transaction)
+    return self.get_decoded_transaction(txid, raw_transaction)
+
+  def get_transactions_from_block(self, block, addresses, known_transactions=None, spent_outputs=None):
+    """
+    known_transactions -- {txid: decoded transaction} that don't need fetching
+    spent_outputs -- set that gets (txid, n) of the inputs of every scanned
+        transaction, whatever it pays to
+    """
+    known_transactions = known_transactions or {}
+    if spent_outputs is None:
+      spent_outputs = set()
     if not TEST_MODE:
-      return self.bitcoind_get_transactions_from_block(block, addresses)
+      return self.bitcoind_get_transactions_from_block(block, addresses, known_transactions, spent_outputs)
     else:
-      return self.blockchain_get_transactions_from_block(block, addresses)
+      return self.blockchain_get_transactions_from_block(block, addresses, known_transactions, spent_outputs)
 
-  def blockchain_get_transactions_from_block(self, block, addresses):
+  def blockchain_get_transactions_from_block(self, block, addresses, known_transactions, spent_outputs):
     transactions_per_address = {}
     for addr in addresses:
       transactions_per_address[addr]= []
 
-    transaction_ids = block['tx']
+    transaction_ids = set(block['tx'])
 
-    address_chunks = slice_list(addresses, 5)
-    transactions_on_addresses = []
+    address_chunks = [chunk for chunk in slice_list(addresses, MULTIADDRESS_CHUNK) if len(chunk) > 0]
+    if not address_chunks:
+      return transactions_per_address
 
-    for chunk in address_chunks:
-      if len(chunk) == 0:
-        continue
+    def multiaddress(chunk):
+      blockchain_rate_limit.acquire()
+      return safe_blockchain_multiaddress(chunk)
 
-      data = safe_blockchain_multiaddress(chunk)
-      if data:
-        txs = data['txs']
-        for tx in txs:
-          if tx['hash'] in transaction_ids:
-            transactions_on_addresses.append(tx['hash'])
-
-    logging.info(transactions_on_addresses)
-
-    for tx in transactions_on_addresses:
+    def raw_transaction(txid):
+      if txid in known_transactions:
+        return None
+      cached = self.tx_cache.get_raw(txid)
+      if cached:
+        return cached
+      blockchain_rate_limit.acquire()
       try:
         logging.debug('getting tx from address')
-        raw_transaction = self.get_raw_transaction(tx)
+        return self.get_raw_transaction(txid)
       except ProtocolError:
+        return None
+
+    pool = ThreadPool(min(BLOCKCHAIN_PARALLELISM, len(address_chunks)))
+    try:
+      transactions_on_addresses = []
+      seen = set()
+      for data in pool.map(multiaddress, address_chunks):
+        if not data:
+          continue
+        for tx in data['txs']:
+          # the same tx shows up in every chunk it pays to
+          if tx['hash'] in transaction_ids and not tx['hash'] in seen:
+            seen.add(tx['hash'])
+            transactions_on_addresses.append(tx['hash'])
+
+      logging.info(transactions_on_addresses)
+
+      raw_transactions = pool.map(raw_transaction, transactions_on_addresses)
+    finally:
+      pool.close()
+
+    for txid, raw_transaction in zip(transactions_on_addresses, raw_transactions):
+      if txid in known_transactions:
+        transaction = known_transactions[txid]
+      elif raw_transaction:
+        transaction = self.get_decoded_transaction(txid, raw_transaction)
+      else:
         continue
-      transaction = self.decode_raw_transaction(raw_transaction)
+      # multiaddr also lists the transactions spending from the addresses
+      add_spent_outputs(transaction, spent_outputs)
       for vout in transaction['vout']:
         if not 'addresses' in vout['scriptPubKey']:
           continue
@@ -424,7 +603,7 @@ class BitcoinClient:
     logging.info(transactions_per_address)
     return transactions_per_address
 
-  def bitcoind_get_transactions_from_block(self, block, addresses):
+  def bitcoind_get_transactions_from_block(self, block, addresses, known_transactions, spent_outputs):
     logging.info(addresses)
     transaction_ids = block['tx']
 
@@ -433,11 +612,14 @@ class BitcoinClient:
       transactions_per_address[addr] = []
 
     for tx in transaction_ids:
-      try:
-        raw_transaction = self.get_raw_transaction(tx)
-      except ProtocolError:
-        continue
-      transaction = self.decode_raw_transaction(raw_transaction)
+      if tx in known_transactions:
+        transaction = known_transactions[tx]
+      else:
+        try:
+          transaction = self.get_decoded_transaction(tx)
+        except ProtocolError:
+          continue
+      add_spent_outputs(transaction, spent_outputs)
       for vout in transaction['vout']:
         if not 'addresses' in vout['scriptPubKey']:
           continue
@@ -0,0 +1,133 @@
+"""
+Serialization of unsigned transactions, byte for byte the same as bitcoind's
+createrawtransaction, and parsing of (partially) signed ones
+"""
+from script import address_to_script
+
+import struct
+
+TX_VERSION = 1
+FINAL_SEQUENCE = 0xffffffff
+MAX_MONEY = 21000000 * 100000000
+
+def var_int(number):
+  if number < 0xfd:
+    return chr(number)
+  if number <= 0xffff:
+    return '\xfd' + struct.pack('<H', number)
+  if number <= 0xffffffff:
+    return '\xfe' + struct.pack('<I', number)
+  return '\xff' + struct.pack('<Q', number)
+
+def var_str(data):
+  return var_int(len(data)) + data
+
+def build_raw_transaction(inputs, outputs, locktime=0):
+  """
+  inputs -- list of {'txid': ..., 'vout': ...}
+  outputs -- (address, satoshi) pairs or a dict, serialized in iteration order
+    just like bitcoind serializes the json object it gets
+  locktime -- nLockTime; inputs get a non-final sequence when it's set,
+    so the locktime is actually enforced
+
+  Returns hex of the unsigned transaction
+  """
+  if isinstance(outputs, dict):
+    outputs = outputs.items()
+
+  if locktime:
+    sequence = FINAL_SEQUENCE - 1
+  else:
+    sequence = FINAL_SEQUENCE
+
+  parts = [struct.pack('<i', TX_VERSION), var_int(len(inputs))]
+
+  for tx_input in inputs:
+    txid = tx_input['txid'].decode('hex')[::-1]
+    parts.append(txid + struct.pack('<I', int(tx_input['vout'])))
+    parts.append(var_str(''))
+    parts.append(struct.pack('<I', sequence))
+
+  parts.append(var_int(len(outputs)))
+
+  for address, satoshi in outputs:
+    satoshi = int(satoshi)
+    if satoshi < 0 or satoshi > MAX_MONEY:
+      raise ValueError('invalid amount for %s: %r' % (address, satoshi))
+    parts.append(struct.pack('<q', satoshi))
+    parts.append(var_str(address_to_script(address)))
+
+  parts.append(struct.pack('<I', locktime))
+
+  return ''.join(parts).encode('hex')
+
+def read_var_int(data, offset):
+  prefix = ord(data[offset])
+  if prefix < 0xfd:
+    return prefix, offset + 1
+  if prefix == 0xfd:
+    return struct.unpack_from('<H', data, offset + 1)[0], offset + 3
+  if prefix == 0xfe:
+    return struct.unpack_from('<I', data, offset + 1)[0], offset + 5
+  return struct.unpack_from('<Q', data, offset + 1)[0], offset + 9
+
+def read_var_str(data, offset):
+  size, offset = read_var_int(data, offset)
+  if offset + size > len(data):
+    raise ValueError('truncated transaction')
+  return data[offset:offset + size], offset + size
+
+def parse_raw_transaction(tx_hex):
+  """
+  Returns {'version', 'inputs', 'outputs', 'locktime'}; inputs are
+  {'txid', 'vout', 'script', 'sequence'}, outputs {'value', 'script'},
+  scripts are binary
+  """
+  data = tx_hex.decode('hex')
+  try:
+    version = struct.unpack_from('<i', data, 0)[0]
+    count, offset = read_var_int(data, 4)
+
+    inputs = []
+    for i in range(count):
+      txid = data[offset:offset + 32][::-1].encode('hex')
+      vout = struct.unpack_from('<I', data, offset + 32)[0]
+      script, offset = read_var_str(data, offset + 36)
+      sequence = struct.unpack_from('<I', data, offset)[0]
+      offset += 4
+      inputs.append({'txid': txid, 'vout': vout, 'script': script, 'sequence': sequence})
+
+    count, offset = read_var_int(data, offset)
+
+    outputs = []
+    for i in range(count):
+      value = struct.unpack_from('<q', data, offset)[0]
+      script, offset = read_var_str(data, offset + 8)
+      outputs.append({'value': value, 'script': script})
+
+    locktime = struct.unpack_from('<I', data, offset)[0]
+  except (struct.error, IndexError):
+    raise ValueError('truncated transaction')
+
+  if offset + 4 != len(data):
+    raise ValueError('trailing data after transaction')
+
+  return {'version': version, 'inputs': inputs, 'outputs': outputs, 'locktime': locktime}
+
+def serialize_transaction(tx):
+  """
+  Inverse of parse_raw_transaction, returns binary
+  """
+  parts = [struct.pack('<i', tx['version']), var_int(len(tx['inputs']))]
+  for tx_input in tx['inputs']:
+    parts.append(tx_input['txid'].decode('hex')[::-1] + struct.pack('<I', tx_input['vout']))
+    parts.append(var_str(tx_input['script']))
+    parts.append(struct.pack('<I', tx_input['sequence']))
+
+  parts.append(var_int(len(tx['outputs'])))
+  for output in tx['outputs']:
+    parts.append(struct.pack('<q', output['value']))
+    parts.append(var_str(output['script']))
+
+  parts.append(struct.pack('<I', tx['locktime']))
+  return ''.join(parts)
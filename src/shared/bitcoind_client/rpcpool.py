@@ -0,0 +1,149 @@
+from xmlrpclib import ProtocolError
+
+import base64
+import decimal
+import httplib
+import itertools
+import json
+import Queue
+import socket
+import urlparse
+
+RPC_POOL_SIZE = 4
+# seconds for a single call, including waiting for a free connection
+RPC_TIMEOUT = 120
+USER_AGENT = 'orisi-rpcpool'
+
+class RPCError(ProtocolError):
+  """
+  Error returned by bitcoind (or an unexpected HTTP reply). Subclasses
+  ProtocolError so code written against jsonrpclib keeps catching it.
+  """
+  def __init__(self, url, code, message):
+    ProtocolError.__init__(self, url, code, message, {})
+    self.code = code
+    self.message = message
+
+  def __str__(self):
+    return 'RPC error %r: %s' % (self.code, self.message)
+
+class PoolTimeoutError(socket.timeout):
+  pass
+
+def encode_decimal(o):
+  if isinstance(o, decimal.Decimal):
+    return float(o)
+  raise TypeError(repr(o) + " is not JSON serializable")
+
+
+class RPCPool(object):
+  """
+  JSON-RPC client for bitcoind that can be used from many threads at once.
+  It keeps up to `size` persistent HTTP/1.1 connections; every call checks
+  one out, uses it exclusively and returns it, so calls never interleave on
+  a socket. Timeouts are per call, the global socket timeout isn't touched.
+
+  Methods are called like on jsonrpclib.Server: pool.getblockcount()
+  """
+  def __init__(self, url, size=RPC_POOL_SIZE, timeout=RPC_TIMEOUT):
+    self._url = urlparse.urlparse(url)
+    self._name = '{}:{}'.format(self._url.hostname, self._url.port)
+    self._path = self._url.path or '/'
+    self._timeout = timeout
+
+    self._headers = {
+      'Host': self._url.hostname,
+      'User-Agent': USER_AGENT,
+      'Content-Type': 'application/json',
+    }
+    if self._url.username:
+      credentials = '{}:{}'.format(self._url.username, self._url.password or '')
+      self._headers['Authorization'] = 'Basic ' + base64.b64encode(credentials)
+
+    self._ids = itertools.count(1)
+    # None is a free slot without an open connection yet
+    self._idle = Queue.LifoQueue()
+    for i in range(size):
+      self._idle.put(None)
+
+  def _new_connection(self, timeout):
+    port = self._url.port or (443 if self._url.scheme == 'https' else 80)
+    if self._url.scheme == 'https':
+      return httplib.HTTPSConnection(self._url.hostname, port, timeout=timeout)
+    return httplib.HTTPConnection(self._url.hostname, port, timeout=timeout)
+
+  def checkout(self, timeout):
+    try:
+      return self._idle.get(timeout=timeout)
+    except Queue.Empty:
+      raise PoolTimeoutError('no free connection to {}'.format(self._name))
+
+  def checkin(self, connection):
+    self._idle.put(connection)
+
+  def _post(self, connection, body, timeout):
+    connection.timeout = timeout
+    if connection.sock:
+      connection.sock.settimeout(timeout)
+    connection.request('POST', self._path, body, self._headers)
+    response = connection.getresponse()
+    return response, response.read()
+
+  def call(self, method, *params, **kwargs):
+    """
+    kwargs: timeout -- seconds for this call instead of the pool default
+    """
+    timeout = kwargs.get('timeout', self._timeout)
+    body = json.dumps({
+      'version': '1.1',
+      'method': method,
+      'params': params,
+      'id': next(self._ids)}, default=encode_decimal)
+
+    connection = self.checkout(timeout)
+    try:
+      reused = connection is not None
+      if not reused:
+        connection = self._new_connection(timeout)
+      try:
+        response, content = self._post(connection, body, timeout)
+      except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+        connection.close()
+        if not reused:
+          raise
+        # bitcoind closed the idle connection in the meantime, try a fresh one
+        response, content = self._post(connection, body, timeout)
+
+      if response.will_close:
+        connection.close()
+    except:
+      if connection is not None:
+        connection.close()
+      self.checkin(None)
+      raise
+    self.checkin(connection)
+
+    return self._result(response, content)
+
+  def _result(self, response, content):
+    try:
+      # floats are plain floats, like jsonrpclib did
+      reply = json.loads(content)
+    except ValueError:
+      raise RPCError(self._name, response.status, response.reason)
+
+    error = reply.get('error')
+    if error:
+      raise RPCError(self._name, error.get('code'), error.get('message'))
+    if response.status != 200:
+      raise RPCError(self._name, response.status, response.reason)
+    if not 'result' in reply:
+      raise RPCError(self._name, -343, 'missing JSON-RPC result')
+    return reply['result']
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    def method(*params, **kwargs):
+      return self.call(name, *params, **kwargs)
+    return method
@@ -0,0 +1,179 @@
+"""
+Bitcoin addresses and output scripts, computed locally instead of asking bitcoind
+"""
+from Crypto.Hash import RIPEMD
+
+import hashlib
+import struct
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+P2PKH_VERSION = 0
+P2SH_VERSION = 5
+TESTNET_P2PKH_VERSION = 111
+TESTNET_P2SH_VERSION = 196
+
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+OP_1 = 0x51
+OP_16 = 0x60
+OP_CHECKMULTISIG = 0xae
+
+class InvalidAddressError(Exception):
+  pass
+
+class InvalidPubkeyError(Exception):
+  pass
+
+class InvalidScriptError(Exception):
+  pass
+
+def sha256d(data):
+  return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def hash160(data):
+  return RIPEMD.new(hashlib.sha256(data).digest()).digest()
+
+def b58encode(data):
+  number = long(data.encode('hex') or '0', 16)
+  encoded = ''
+  while number > 0:
+    number, rest = divmod(number, 58)
+    encoded = B58_ALPHABET[rest] + encoded
+
+  # leading zero bytes are encoded as '1's
+  padding = len(data) - len(data.lstrip('\0'))
+  return B58_ALPHABET[0] * padding + encoded
+
+def b58decode(encoded):
+  number = 0
+  for char in encoded:
+    if not char in B58_ALPHABET:
+      raise InvalidAddressError(encoded)
+    number = number * 58 + B58_ALPHABET.index(char)
+
+  data = '%x' % number if number else ''
+  if len(data) % 2:
+    data = '0' + data
+  data = data.decode('hex')
+
+  padding = len(encoded) - len(encoded.lstrip(B58_ALPHABET[0]))
+  return '\0' * padding + data
+
+def b58check_encode(version, payload):
+  data = chr(version) + payload
+  return b58encode(data + sha256d(data)[:4])
+
+def b58check_decode(encoded):
+  data = b58decode(encoded)
+  if len(data) < 5 or sha256d(data[:-4])[:4] != data[-4:]:
+    raise InvalidAddressError(encoded)
+  return ord(data[0]), data[1:-4]
+
+def address_to_script(address):
+  """
+  Returns binary scriptPubKey paying to P2PKH or P2SH address
+  """
+  version, payload = b58check_decode(address)
+  if len(payload) != 20:
+    raise InvalidAddressError(address)
+
+  if version in (P2PKH_VERSION, TESTNET_P2PKH_VERSION):
+    # OP_DUP OP_HASH160 <hash> OP_EQUALVERIFY OP_CHECKSIG
+    return '\x76\xa9\x14' + payload + '\x88\xac'
+  if version in (P2SH_VERSION, TESTNET_P2SH_VERSION):
+    # OP_HASH160 <hash> OP_EQUAL
+    return '\xa9\x14' + payload + '\x87'
+  raise InvalidAddressError(address)
+
+def script_to_p2sh_address(script_hex, version=P2SH_VERSION):
+  return b58check_encode(version, hash160(script_hex.decode('hex')))
+
+def pubkey_to_address(pubkey_hex, version=P2PKH_VERSION):
+  return b58check_encode(version, hash160(pubkey_hex.decode('hex')))
+
+def multisig_redeem_script(req_sigs, pubkeys):
+  """
+  OP_<req_sigs> <pubkey>... OP_<len(pubkeys)> OP_CHECKMULTISIG, the same script
+  bitcoind's createmultisig returns for hex pubkeys (in the given order)
+  """
+  if not 1 <= len(pubkeys) <= 16 or not 1 <= req_sigs <= len(pubkeys):
+    raise InvalidPubkeyError('can\'t make %r of %r multisig' % (req_sigs, len(pubkeys)))
+
+  script = chr(OP_1 - 1 + req_sigs)
+  for pubkey in pubkeys:
+    try:
+      key = pubkey.decode('hex')
+    except (TypeError, AttributeError):
+      raise InvalidPubkeyError(pubkey)
+
+    compressed = len(key) == 33 and key[0] in '\x02\x03'
+    uncompressed = len(key) == 65 and key[0] == '\x04'
+    if not compressed and not uncompressed:
+      raise InvalidPubkeyError(pubkey)
+
+    script += chr(len(key)) + key
+  script += chr(OP_1 - 1 + len(pubkeys)) + chr(OP_CHECKMULTISIG)
+  return script.encode('hex')
+
+def push_data(data):
+  """
+  Shortest script pushing data
+  """
+  if len(data) < OP_PUSHDATA1:
+    return chr(len(data)) + data
+  if len(data) <= 0xff:
+    return chr(OP_PUSHDATA1) + chr(len(data)) + data
+  if len(data) <= 0xffff:
+    return chr(OP_PUSHDATA2) + struct.pack('<H', len(data)) + data
+  return chr(OP_PUSHDATA4) + struct.pack('<I', len(data)) + data
+
+def script_elements(script):
+  """
+  Splits binary script into opcodes (ints) and pushed data (strings)
+  """
+  elements = []
+  i = 0
+  while i < len(script):
+    opcode = ord(script[i])
+    i += 1
+    if opcode == OP_0 or opcode > OP_PUSHDATA4:
+      elements.append(opcode if opcode else '')
+      continue
+
+    if opcode < OP_PUSHDATA1:
+      size = opcode
+    elif opcode == OP_PUSHDATA1:
+      size = ord(script[i:i+1] or '\x00')
+      i += 1
+    elif opcode == OP_PUSHDATA2:
+      size = struct.unpack('<H', script[i:i+2].ljust(2, '\x00'))[0]
+      i += 2
+    else:
+      size = struct.unpack('<I', script[i:i+4].ljust(4, '\x00'))[0]
+      i += 4
+
+    if i + size > len(script):
+      raise InvalidScriptError('push past the end of script')
+    elements.append(script[i:i+size])
+    i += size
+  return elements
+
+def parse_multisig_redeem_script(script_hex):
+  """
+  Inverse of multisig_redeem_script, returns (req_sigs, hex pubkeys)
+  """
+  elements = script_elements(script_hex.decode('hex'))
+  if len(elements) < 4 or elements[-1] != OP_CHECKMULTISIG:
+    raise InvalidScriptError('not a multisig script: %s' % script_hex)
+
+  req_sigs, pubkey_count = elements[0], elements[-2]
+  pubkeys = elements[1:-2]
+  if not isinstance(req_sigs, int) or not isinstance(pubkey_count, int) \
+      or not OP_1 <= req_sigs <= OP_16 or pubkey_count - OP_1 + 1 != len(pubkeys) \
+      or not all(isinstance(pubkey, str) for pubkey in pubkeys):
+    raise InvalidScriptError('not a multisig script: %s' % script_hex)
+
+  return req_sigs - OP_1 + 1, [pubkey.encode('hex') for pubkey in pubkeys]
@@ -0,0 +1,307 @@
+"""
+Finds out which keys of a P2SH multisig already signed a transaction by
+verifying the scriptSig signatures locally, without asking bitcoind
+"""
+from rawtransaction import parse_raw_transaction, serialize_transaction
+from script import (
+    sha256d,
+    push_data,
+    script_elements,
+    parse_multisig_redeem_script,
+    InvalidScriptError)
+
+import struct
+
+SIGHASH_ALL = 0x01
+
+# secp256k1
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+class InvalidSignatureError(Exception):
+  pass
+
+def inverse(a, n):
+  return pow(a, n - 2, n)
+
+# points in jacobian coordinates (x, y, z), None is the point at infinity
+def to_jacobian(point):
+  return (point[0], point[1], 1)
+
+def from_jacobian(point):
+  if point is None:
+    return None
+  x, y, z = point
+  zinv = inverse(z, P)
+  return (x * zinv * zinv % P, y * zinv * zinv * zinv % P)
+
+def jacobian_double(point):
+  if point is None or point[1] == 0:
+    return None
+  x, y, z = point
+  ysq = y * y % P
+  s = 4 * x * ysq % P
+  m = 3 * x * x % P
+  nx = (m * m - 2 * s) % P
+  ny = (m * (s - nx) - 8 * ysq * ysq) % P
+  nz = 2 * y * z % P
+  return (nx, ny, nz)
+
+def jacobian_add(p, q):
+  if p is None:
+    return q
+  if q is None:
+    return p
+  x1, y1, z1 = p
+  x2, y2, z2 = q
+  z1sq, z2sq = z1 * z1 % P, z2 * z2 % P
+  u1, u2 = x1 * z2sq % P, x2 * z1sq % P
+  s1, s2 = y1 * z2sq * z2 % P, y2 * z1sq * z1 % P
+  if u1 == u2:
+    if s1 != s2:
+      return None
+    return jacobian_double(p)
+  h = u2 - u1
+  r = s2 - s1
+  h2 = h * h % P
+  h3 = h * h2 % P
+  u1h2 = u1 * h2 % P
+  nx = (r * r - h3 - 2 * u1h2) % P
+  ny = (r * (u1h2 - nx) - s1 * h3) % P
+  nz = h * z1 * z2 % P
+  return (nx, ny, nz)
+
+def double_multiply(a, p, b, q):
+  """
+  a*P + b*Q with one pass over the bits (Shamir's trick)
+  """
+  p, q = to_jacobian(p), to_jacobian(q)
+  pq = jacobian_add(p, q)
+  result = None
+  for bit in range(max(a.bit_length(), b.bit_length()) - 1, -1, -1):
+    result = jacobian_double(result)
+    if (a >> bit) & 1 and (b >> bit) & 1:
+      result = jacobian_add(result, pq)
+    elif (a >> bit) & 1:
+      result = jacobian_add(result, p)
+    elif (b >> bit) & 1:
+      result = jacobian_add(result, q)
+  return from_jacobian(result)
+
+def decode_pubkey(pubkey):
+  """
+  Binary SEC pubkey (compressed or not) to a curve point
+  """
+  if len(pubkey) == 65 and pubkey[0] == '\x04':
+    x, y = int(pubkey[1:33].encode('hex'), 16), int(pubkey[33:].encode('hex'), 16)
+  elif len(pubkey) == 33 and pubkey[0] in '\x02\x03':
+    x = int(pubkey[1:].encode('hex'), 16)
+    y = pow((x * x * x + 7) % P, (P + 1) // 4, P)
+    if (y & 1) != (ord(pubkey[0]) & 1):
+      y = P - y
+  else:
+    raise InvalidSignatureError('bad pubkey')
+
+  if (y * y - x * x * x - 7) % P != 0:
+    raise InvalidSignatureError('pubkey not on curve')
+  return (x, y)
+
+def decode_der_signature(signature):
+  """
+  DER signature (without the hashtype byte) to (r, s)
+  """
+  def read_int(offset):
+    if signature[offset:offset+1] != '\x02':
+      raise InvalidSignatureError('bad DER integer')
+    size = ord(signature[offset + 1])
+    value = signature[offset + 2:offset + 2 + size]
+    if len(value) != size or not size:
+      raise InvalidSignatureError('bad DER integer')
+    return int(value.encode('hex'), 16), offset + 2 + size
+
+  if len(signature) < 8 or signature[0] != '\x30' or ord(signature[1]) != len(signature) - 2:
+    raise InvalidSignatureError('bad DER signature')
+  r, offset = read_int(2)
+  s, offset = read_int(offset)
+  if offset != len(signature):
+    raise InvalidSignatureError('bad DER signature')
+  return r, s
+
+def verify(pubkey_point, digest, r, s):
+  if not 0 < r < N or not 0 < s < N:
+    return False
+  w = inverse(s, N)
+  point = double_multiply(digest * w % N, G, r * w % N, pubkey_point)
+  return point is not None and point[0] % N == r
+
+def signature_hash(tx, index, subscript, hashtype=SIGHASH_ALL):
+  """
+  Digest signed by an input's signature, for SIGHASH_ALL
+  """
+  inputs = []
+  for i, tx_input in enumerate(tx['inputs']):
+    tx_input = dict(tx_input)
+    tx_input['script'] = subscript if i == index else ''
+    inputs.append(tx_input)
+
+  data = serialize_transaction(dict(tx, inputs=inputs)) + struct.pack('<I', hashtype)
+  return int(sha256d(data).encode('hex'), 16)
+
+def input_signatures(tx, index, redeem_script):
+  """
+  Returns (hex pubkey, signature) pairs for the pubkeys of redeem_script
+  that have a valid signature in the input
+  """
+  req_sigs, pubkeys = parse_multisig_redeem_script(redeem_script)
+
+  script_sig = tx['inputs'][index]['script']
+  if not script_sig:
+    return []
+
+  elements = script_elements(script_sig)
+  # OP_0 <sig>... <redeemScript>; bitcoind puts OP_0 in place of missing signatures
+  signatures = [e for e in elements[1:-1] if isinstance(e, str) and e]
+
+  signed = []
+  subscript = redeem_script.decode('hex')
+  digest = None
+  # CHECKMULTISIG needs signatures in the pubkeys order, so keys are tried in turn
+  key_index = 0
+  for signature in signatures:
+    hashtype = ord(signature[-1])
+    if hashtype != SIGHASH_ALL:
+      continue
+    try:
+      r, s = decode_der_signature(signature[:-1])
+    except InvalidSignatureError:
+      continue
+
+    if digest is None:
+      digest = signature_hash(tx, index, subscript)
+
+    while key_index < len(pubkeys):
+      pubkey = pubkeys[key_index]
+      key_index += 1
+      try:
+        point = decode_pubkey(pubkey.decode('hex'))
+      except InvalidSignatureError:
+        continue
+      if verify(point, digest, r, s):
+        signed.append((pubkey, signature))
+        break
+  return signed
+
+def redeem_scripts_by_input(prevtxs):
+  redeem_scripts = {}
+  for prevtx in prevtxs:
+    if 'redeemScript' in prevtx:
+      redeem_scripts[(prevtx['txid'], int(prevtx['vout']))] = prevtx['redeemScript']
+  return redeem_scripts
+
+def signature_state(tx_hex, prevtxs):
+  """
+  For every input of the transaction returns
+  {'txid', 'vout', 'req_sigs', 'pubkeys', 'signed'} where signed are the pubkeys
+  that already signed it. Inputs without a redeemScript in prevtxs are skipped.
+  """
+  tx = parse_raw_transaction(tx_hex)
+  redeem_scripts = redeem_scripts_by_input(prevtxs)
+
+  state = []
+  for index, tx_input in enumerate(tx['inputs']):
+    redeem_script = redeem_scripts.get((tx_input['txid'], tx_input['vout']))
+    if not redeem_script:
+      continue
+    try:
+      req_sigs, pubkeys = parse_multisig_redeem_script(redeem_script)
+      signed = [pubkey for pubkey, signature in input_signatures(tx, index, redeem_script)]
+    except (InvalidScriptError, ValueError):
+      continue
+    state.append({
+      'txid': tx_input['txid'],
+      'vout': tx_input['vout'],
+      'req_sigs': req_sigs,
+      'pubkeys': pubkeys,
+      'signed': signed,
+    })
+  return state
+
+def unsigned_body(tx):
+  inputs = [dict(tx_input, script='') for tx_input in tx['inputs']]
+  return serialize_transaction(dict(tx, inputs=inputs))
+
+def collect_signatures(base, variant_hex, redeem_scripts, collected):
+  """
+  Adds the valid signatures of variant (a copy of base signed by some keys)
+  to collected, [{pubkey: signature}] by input of base. A variant of
+  a different transaction adds nothing. Returns how many were added.
+  """
+  try:
+    variant = parse_raw_transaction(variant_hex)
+  except ValueError:
+    return 0
+  if unsigned_body(variant) != unsigned_body(base):
+    # signatures of a different transaction
+    return 0
+
+  added = 0
+  for index, tx_input in enumerate(variant['inputs']):
+    redeem_script = redeem_scripts.get((tx_input['txid'], tx_input['vout']))
+    if not redeem_script:
+      continue
+    try:
+      for pubkey, signature in input_signatures(variant, index, redeem_script):
+        if not pubkey in collected[index]:
+          collected[index][pubkey] = signature
+          added += 1
+    except (InvalidScriptError, ValueError):
+      continue
+  return added
+
+def apply_signatures(base, collected, redeem_scripts):
+  """
+  Signatures go in the redeem script's pubkey order, at most req_sigs of them,
+  missing ones are OP_0 -- the layout bitcoind's signrawtransaction produces,
+  so every oracle merging the same signatures gets the same transaction
+  """
+  for index, tx_input in enumerate(base['inputs']):
+    redeem_script = redeem_scripts.get((tx_input['txid'], tx_input['vout']))
+    if not redeem_script or not collected[index]:
+      continue
+    req_sigs, pubkeys = parse_multisig_redeem_script(redeem_script)
+
+    signatures = [collected[index][pubkey] for pubkey in pubkeys if pubkey in collected[index]][:req_sigs]
+    script = '\x00' + ''.join(push_data(signature) for signature in signatures)
+    script += '\x00' * (req_sigs - len(signatures))
+    script += push_data(redeem_script.decode('hex'))
+    tx_input['script'] = script
+
+  return serialize_transaction(base).encode('hex')
+
+def merge_signatures(base_hex, variants_hex, prevtxs):
+  """
+  Combines valid signatures found in base and any of the variants (copies of
+  base signed by different keys) into base. Returns hex of the merged transaction.
+  """
+  base = parse_raw_transaction(base_hex)
+  redeem_scripts = redeem_scripts_by_input(prevtxs)
+
+  collected = [{} for tx_input in base['inputs']]
+  for variant_hex in [base_hex] + list(variants_hex):
+    collect_signatures(base, variant_hex, redeem_scripts, collected)
+  return apply_signatures(base, collected, redeem_scripts)
+
+def add_signatures(base_hex, variant_hex, prevtxs):
+  """
+  Merges a single variant into base, returns (merged hex, number of valid
+  signatures the variant had that base didn't)
+  """
+  base = parse_raw_transaction(base_hex)
+  redeem_scripts = redeem_scripts_by_input(prevtxs)
+
+  collected = [{} for tx_input in base['inputs']]
+  collect_signatures(base, base_hex, redeem_scripts, collected)
+  added = collect_signatures(base, variant_hex, redeem_scripts, collected)
+  return apply_signatures(base, collected, redeem_scripts), added
@@ -0,0 +1,65 @@
+import copy
+import sys
+import threading
+
+class Flight:
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+    self.waiters = 0
+
+
+class SingleFlight:
+  """
+  Coalesces identical concurrent calls: while a call for some key is running,
+  other callers with the same key wait for it and get its result (or its
+  exception) instead of issuing their own request.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.flights = {}
+    self.calls = 0
+    self.deduplicated = 0
+
+  def do(self, key, fun, *args, **kwargs):
+    with self.lock:
+      self.calls += 1
+      flight = self.flights.get(key)
+      if flight:
+        self.deduplicated += 1
+        flight.waiters += 1
+        leader = False
+      else:
+        flight = self.flights[key] = Flight()
+        leader = True
+
+    if not leader:
+      flight.done.wait()
+      if flight.error:
+        raise flight.error[0], flight.error[1], flight.error[2]
+      # every caller gets its own copy, they may modify it
+      return copy.deepcopy(flight.result)
+
+    result = None
+    try:
+      result = fun(*args, **kwargs)
+      return result
+    except:
+      flight.error = sys.exc_info()
+      raise
+    finally:
+      with self.lock:
+        del self.flights[key]
+      if flight.waiters and not flight.error:
+        # snapshot before the leader's caller gets to modify it
+        flight.result = copy.deepcopy(result)
+      flight.done.set()
+
+  def stats(self):
+    with self.lock:
+      return {
+        'calls': self.calls,
+        'deduplicated': self.deduplicated,
+        'in_flight': len(self.flights),
+      }
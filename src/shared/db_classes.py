@@ -1,4 +1,8 @@
 import sqlite3
+import threading
+
+# rows fetched at once by TableDb.iterate
+ITER_BATCH_SIZE = 500
 
 class GeneralDb:
 
@@ -7,8 +11,21 @@ class GeneralDb:
     self.connect()
 
   def connect(self):
-    self.conn = sqlite3.connect(self._filename, detect_types=sqlite3.PARSE_COLNAMES)
-    self.conn.row_factory = sqlite3.Row
+    # sqlite connections can't be shared between threads, so every thread
+    # (main loop and workers) gets its own connection to the same file
+    if not hasattr(self, '_local'):
+      self._local = threading.local()
+      # serializes read-modify-write sequences of the worker threads sharing
+      # this db object; other databases and db objects aren't held up
+      self.write_lock = threading.RLock()
+    self._local.conn = sqlite3.connect(self._filename, detect_types=sqlite3.PARSE_COLNAMES)
+    self._local.conn.row_factory = sqlite3.Row
+
+  @property
+  def conn(self):
+    if getattr(self._local, 'conn', None) is None:
+      self.connect()
+    return self._local.conn
 
   def commit(self):
     self.conn.commit()
@@ -19,9 +36,6 @@ class GeneralDb:
     self.conn.commit()
 
   def get_cursor(self):
-    if not self.conn:
-      self.connect()
-
     try:
       return self.conn.cursor()
     except:
@@ -36,11 +50,22 @@ class TableDb(object):
   """
   table_name = "TableDB"
   exist_sql = "select name from sqlite_master where type='table' and name='{0}'"
+  columns_sql = "pragma table_info({0})"
+  add_column_sql = "alter table {0} add column {1} {2}"
+  index_sql = "create index if not exists {0}_{1} on {0} ({1})"
+  iterate_sql = "select {1} from {0} where id>?{2} order by id limit ?"
+
+  # (name, definition) of columns added after the table was first released,
+  # they're added to already existing databases on first use
+  extra_columns = []
+  # columns that get an index
+  indexes = []
 
   def __init__(self, db):
     self.db = db
     if not self.table_exists():
       self.create_table()
+    self.migrate()
 
   def table_exists(self):
     cursor = self.db.get_cursor()
@@ -55,6 +80,65 @@ class TableDb(object):
     cursor.execute(sql)
     self.db.commit()
 
+  def migrate(self):
+    if not self.extra_columns and not self.indexes:
+      return
+
+    migrated = self.db.__dict__.setdefault('_migrated_tables', set())
+    if self.table_name in migrated:
+      return
+
+    cursor = self.db.get_cursor()
+    rows = cursor.execute(self.columns_sql.format(self.table_name)).fetchall()
+    existing = set(row['name'] for row in rows)
+
+    for name, definition in self.extra_columns:
+      if not name in existing:
+        cursor.execute(self.add_column_sql.format(self.table_name, name, definition))
+
+    for column in self.indexes:
+      cursor.execute(self.index_sql.format(self.table_name, column))
+    self.db.commit()
+
+    migrated.add(self.table_name)
+
+  def iterate(self, columns=None, where=None, args=(), batch_size=ITER_BATCH_SIZE):
+    """
+    Streams rows as dicts, ordered by id. Rows are fetched batch_size at a time
+    (keyed on id, not offset), so walking a huge table uses constant memory.
+    columns limits the returned columns, where/args add an extra condition.
+    """
+    if columns:
+      selected = list(columns)
+      if not 'id' in selected:
+        selected.append('id')
+      fields = ', '.join(selected)
+    else:
+      fields = '*'
+    condition = ' and ({})'.format(where) if where else ''
+    sql = self.iterate_sql.format(self.table_name, fields, condition)
+
+    last_id = -1
+    while True:
+      cursor = self.db.get_cursor()
+      rows = cursor.execute(sql, (last_id, ) + tuple(args) + (batch_size, )).fetchall()
+
+      for row in rows:
+        row = dict(row)
+        last_id = row['id']
+        if columns and not 'id' in columns:
+          del row['id']
+        yield row
+
+      if len(rows) < batch_size:
+        return
+
+  def iter_all(self, columns=None):
+    return self.iterate(columns)
+
+  def get_all(self):
+    return list(self.iter_all())
+
   def args_for_obj(self, obj):
     raise NotImplementedError()
 
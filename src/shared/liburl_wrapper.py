@@ -1,79 +1,181 @@
-import signal
 import socket
-import urllib2
+import httplib
 import urllib
+import urlparse
 import logging
 import json
+import threading
+import time
 
 TIMEOUT = 10
 
-socket.setdefaulttimeout(TIMEOUT)
+# idle keep-alive connections kept for every host
+MAX_IDLE_CONNECTIONS = 4
+MAX_REDIRECTS = 5
+READ_CHUNK = 64 * 1024
+USER_AGENT = 'orisi'
 
-def timeout_catcher(signum, _):
-  raise urllib2.URLError("Read timeout")
+class FetchError(Exception):
+  pass
 
-signal.signal(signal.SIGALRM, timeout_catcher)
+class HttpFetcher:
+  """
+  HTTP(S) client that reuses keep-alive connections per host. Every request has
+  a deadline enforced with socket timeouts (no signals), so it can be used
+  from any number of threads at once.
+  """
+  def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+    self.max_idle = max_idle
+    self.lock = threading.Lock()
+    # (scheme, host, port) -> idle connections
+    self.idle = {}
+
+  def checkout(self, key, timeout):
+    with self.lock:
+      connections = self.idle.get(key)
+      if connections:
+        return connections.pop(), True
+
+    scheme, host, port = key
+    if scheme == 'https':
+      return httplib.HTTPSConnection(host, port, timeout=timeout), False
+    return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+  def checkin(self, key, connection):
+    with self.lock:
+      connections = self.idle.setdefault(key, [])
+      if len(connections) < self.max_idle:
+        connections.append(connection)
+        return
+    connection.close()
+
+  def remaining(self, deadline):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      raise FetchError('timeout')
+    return remaining
+
+  def set_timeout(self, connection, deadline):
+    remaining = self.remaining(deadline)
+    connection.timeout = remaining
+    if connection.sock:
+      connection.sock.settimeout(remaining)
+
+  def read(self, connection, response, deadline):
+    chunks = []
+    while True:
+      self.set_timeout(connection, deadline)
+      chunk = response.read(READ_CHUNK)
+      if not chunk:
+        return ''.join(chunks)
+      chunks.append(chunk)
+
+  def request(self, url, data, deadline):
+    parsed = urlparse.urlparse(url)
+    scheme = parsed.scheme or 'http'
+    port = parsed.port or (443 if scheme == 'https' else 80)
+    key = (scheme, parsed.hostname, port)
+
+    path = parsed.path or '/'
+    if parsed.query:
+      path += '?' + parsed.query
+
+    headers = {'User-Agent': USER_AGENT, 'Connection': 'keep-alive'}
+    if data is None:
+      method = 'GET'
+    else:
+      method = 'POST'
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    while True:
+      connection, reused = self.checkout(key, self.remaining(deadline))
+      try:
+        self.set_timeout(connection, deadline)
+        connection.request(method, path, data, headers)
+        response = connection.getresponse()
+        content = self.read(connection, response, deadline)
+      except (httplib.HTTPException, socket.error):
+        connection.close()
+        if reused:
+          # the server closed the idle connection in the meantime, try a fresh one
+          continue
+        raise
+      except:
+        connection.close()
+        raise
+
+      if response.will_close:
+        connection.close()
+      else:
+        self.checkin(key, connection)
+      return response.status, response.getheader('location'), content
+
+  def fetch(self, url, data=None, timeout=TIMEOUT):
+    """
+    Returns the response body; raises on errors, HTTP errors and when
+    the whole exchange (including redirects) takes longer than timeout
+    """
+    deadline = time.time() + timeout
+
+    for _ in range(MAX_REDIRECTS + 1):
+      status, location, content = self.request(url, data, deadline)
+
+      if status in (301, 302, 303, 307) and location:
+        url = urlparse.urljoin(url, location)
+        if status != 307:
+          # like urllib2, redirected POST becomes a GET
+          data = None
+        continue
+
+      if status >= 400:
+        raise FetchError('HTTP %r for %s' % (status, url))
+      return content
+
+    raise FetchError('too many redirects for %s' % url)
+
+fetcher = HttpFetcher()
 
 def safe_read(url, timeout_time):
-  signal.setitimer(signal.ITIMER_REAL, timeout_time)
   try:
-    content = urllib2.urlopen(url, timeout=timeout_time).read()
-    signal.setitimer(signal.ITIMER_REAL, 0)
-    return content
+    return fetcher.fetch(url, timeout=timeout_time)
   except:
-    signal.setitimer(signal.ITIMER_REAL, 0)
     return None
 
 def safe_pushtx(tx, timeout_time = 120):
   logging.info('pushing to eligius')
-  signal.setitimer(signal.ITIMER_REAL, timeout_time)
   try:
     #thanks http://www.pythonforbeginners.com/python-on-the-web/how-to-use-urllib2-in-python/
     query_args = {'send': 'Push', 'transaction': tx}
     data = urllib.urlencode(query_args)
     url = 'http://eligius.st/~wizkid057/newstats/pushtxn.php'
-    content = urllib2.urlopen(url, data, timeout=timeout_time).read()
-    signal.setitimer(signal.ITIMER_REAL, 0)
-    return content
+    return fetcher.fetch(url, data, timeout=timeout_time)
   except:
-    signal.setitimer(signal.ITIMER_REAL, 0)
     return None
 
 def safe_blockchain_multiaddress(addresses, timeout_time = 120):
-  signal.setitimer(signal.ITIMER_REAL, timeout_time)
   try:
     url = 'http://blockchain.info/multiaddr?active={}'.format('|'.join(addresses))
     logging.debug('url: %r' % url)
-    content = urllib2.urlopen(url, timeout=timeout_time).read()
-    signal.setitimer(signal.ITIMER_REAL, 0)
+    content = fetcher.fetch(url, timeout=timeout_time)
     return json.loads(content)
   except:
     logging.warning('timeout on blockchain multiaddress')
-    signal.setitimer(signal.ITIMER_REAL, 0)
     return None
 
 def safe_nonbitcoind_blockchain_getblock(block_hash, timeout_time=120):
-  signal.setitimer(signal.ITIMER_REAL, timeout_time)
   try:
     url = 'http://blockchain.info/rawblock/{}'.format(block_hash)
-    content = urllib2.urlopen(url, timeout=timeout_time).read()
-    signal.setitimer(signal.ITIMER_REAL, 0)
+    content = fetcher.fetch(url, timeout=timeout_time)
     return json.loads(content)
   except:
     logging.warning('error getting info from block')
-    signal.setitimer(signal.ITIMER_REAL, 0)
     return None
 
 def safe_get_raw_transaction(txid, timeout_time=120):
-  print "getting raw transaction"
-  signal.setitimer(signal.ITIMER_REAL, timeout_time)
+  logging.debug('getting raw transaction')
   try:
     url = 'http://blockchain.info/tx/{}?format=hex'.format(txid)
-    content = urllib2.urlopen(url, timeout=timeout_time).read()
-    signal.setitimer(signal.ITIMER_REAL, 0)
-    return content
+    return fetcher.fetch(url, timeout=timeout_time)
   except:
     logging.warning('timeout on get_raw_transaction')
-    signal.setitimer(signal.ITIMER_REAL, 0)
     return None
-
@@ -0,0 +1,42 @@
+import threading
+import time
+
+class TokenBucket:
+  """
+  Allows `rate` operations per second on average, with bursts of up to `capacity`
+  """
+  def __init__(self, rate, capacity):
+    self.rate = float(rate)
+    self.capacity = float(capacity)
+    self.tokens = float(capacity)
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  def refill(self):
+    now = time.time()
+    self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  def consume(self, tokens=1):
+    """
+    Takes tokens if available, returns False otherwise
+    """
+    with self.lock:
+      self.refill()
+      if self.tokens < tokens:
+        return False
+      self.tokens -= tokens
+      return True
+
+  def acquire(self, tokens=1):
+    """
+    Blocks until tokens are available
+    """
+    while True:
+      with self.lock:
+        self.refill()
+        if self.tokens >= tokens:
+          self.tokens -= tokens
+          return
+        wait = (tokens - self.tokens) / self.rate
+      time.sleep(wait)
@@ -0,0 +1,43 @@
+from decimal import Decimal, Context
+
+COIN = 100000000
+
+# conversions don't depend on whatever precision the global decimal context has
+EXACT = Context(prec=28)
+
+class Satoshi(long):
+  """
+  Amount of bitcoin as an integer number of satoshi. Fee arithmetic is plain
+  integer arithmetic; BTC values are converted only when talking to bitcoind
+  or reading them from messages
+  """
+  __slots__ = ()
+
+  @classmethod
+  def from_btc(cls, value):
+    if isinstance(value, float):
+      # same rounding as bitcoind's AmountFromValue
+      return cls(int(round(value * COIN)))
+    amount = EXACT.multiply(Decimal(value), COIN)
+    return cls(amount.to_integral_value(context=EXACT))
+
+  def to_btc(self):
+    return EXACT.divide(Decimal(long(self)), COIN)
+
+  def to_float(self):
+    # bitcoind rpc expects floats
+    return float(self.to_btc())
+
+  def __add__(self, other):
+    return Satoshi(long(self) + other)
+
+  __radd__ = __add__
+
+  def __sub__(self, other):
+    return Satoshi(long(self) - other)
+
+  def __rsub__(self, other):
+    return Satoshi(other - long(self))
+
+  def __neg__(self):
+    return Satoshi(-long(self))
@@ -0,0 +1,181 @@
+from shared.db_classes import TableDb, GeneralDb
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# shared by the oracle and the client, so by default it doesn't depend on the working directory
+try:
+  from settings_local import TX_CACHE_FILE
+except ImportError:
+  TX_CACHE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'txcache.db')
+
+# when the cached transactions take more than that, the least recently
+# used ones are evicted until the cache is down to TX_CACHE_LOW_WATER
+TX_CACHE_MAX_SIZE = 128 * 1024 * 1024
+TX_CACHE_LOW_WATER = 96 * 1024 * 1024
+# last_access is updated at most that often, so reads don't turn into writes
+TX_CACHE_TOUCH_INTERVAL = 60 * 60
+
+def txid_for_raw(raw_transaction):
+  return hashlib.sha256(hashlib.sha256(raw_transaction.decode('hex')).digest()).digest()[::-1].encode('hex')
+
+
+class TransactionCacheDb(GeneralDb):
+
+  def __init__(self, filename=TX_CACHE_FILE):
+    self._filename = filename
+    self.connect()
+
+
+class CachedTransaction(TableDb):
+  """
+  Raw transactions (and their decoded form) by txid. A txid is the hash of
+  the raw transaction, so entries never go stale.
+  """
+  table_name = "cached_transaction"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      txid text unique, \
+      raw blob not null, \
+      decoded text, \
+      size integer not null, \
+      last_access integer not null);"
+  insert_sql = "insert or ignore into {0} (txid, raw, size, last_access) values (?, ?, ?, ?)"
+  get_sql = "select * from {0} where txid=?"
+  decoded_sql = "update {0} set decoded=?, size=? where txid=?"
+  touch_sql = "update {0} set last_access=? where txid=?"
+  size_sql = "select coalesce(sum(size), 0) as total from {0}"
+  oldest_sql = "select id, size from {0} order by last_access, id limit ?"
+  delete_sql = "delete from {0} where id=?"
+
+  indexes = ['last_access']
+
+  def args_for_obj(self, obj):
+    return [obj['txid'], buffer(obj['raw'].decode('hex')), obj['size'], obj['last_access']]
+
+  def get(self, txid):
+    cursor = self.db.get_cursor()
+    sql = self.get_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (txid, )).fetchone()
+    if row:
+      return dict(row)
+    return None
+
+  def set_decoded(self, txid, decoded, size):
+    sql = self.decoded_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (decoded, size, txid))
+
+  def touch(self, txid, now):
+    sql = self.touch_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (now, txid))
+
+  def total_size(self):
+    cursor = self.db.get_cursor()
+    sql = self.size_sql.format(self.table_name)
+    return cursor.execute(sql).fetchone()['total']
+
+  def get_oldest(self, count):
+    cursor = self.db.get_cursor()
+    sql = self.oldest_sql.format(self.table_name)
+
+    rows = cursor.execute(sql, (count, )).fetchall()
+    return [dict(row) for row in rows]
+
+  def args_for_obj_delete(self, obj):
+    return [obj['id']]
+
+
+class TransactionCache:
+  """
+  Persistent txid -> raw/decoded transaction cache with size based LRU eviction,
+  shared by BitcoinClient and the client CLI
+  """
+  def __init__(self, filename=TX_CACHE_FILE, max_size=TX_CACHE_MAX_SIZE, low_water=TX_CACHE_LOW_WATER):
+    self.db = TransactionCacheDb(filename)
+    self.max_size = max_size
+    self.low_water = low_water
+    self.lock = threading.Lock()
+    self.size = None
+
+  def table(self):
+    return CachedTransaction(self.db)
+
+  def lookup(self, txid):
+    entry = self.table().get(txid)
+    if not entry:
+      return None
+
+    now = int(time.time())
+    if entry['last_access'] < now - TX_CACHE_TOUCH_INTERVAL:
+      self.table().touch(txid, now)
+    return entry
+
+  def get_raw(self, txid):
+    entry = self.lookup(txid)
+    if not entry:
+      return None
+    return str(entry['raw']).encode('hex')
+
+  def get_decoded(self, txid):
+    entry = self.lookup(txid)
+    if not entry or not entry['decoded']:
+      return None
+    return json.loads(entry['decoded'])
+
+  def put_raw(self, txid, raw_transaction):
+    try:
+      valid = txid_for_raw(raw_transaction) == txid
+    except (TypeError, ValueError):
+      valid = False
+    if not valid:
+      # not what we asked for (error page, truncated response...), don't keep it
+      logging.warning('raw transaction does not match txid %r, not caching' % txid)
+      return
+
+    size = len(raw_transaction) / 2
+    self.table().save({
+      'txid': txid,
+      'raw': raw_transaction,
+      'size': size,
+      'last_access': int(time.time())
+    })
+    self.grow(size)
+
+  def put_decoded(self, txid, decoded):
+    entry = self.table().get(txid)
+    if not entry or entry['decoded']:
+      return
+
+    decoded = json.dumps(decoded)
+    size = len(entry['raw']) + len(decoded)
+    self.table().set_decoded(txid, decoded, size)
+    self.grow(size - entry['size'])
+
+  def grow(self, size):
+    with self.lock:
+      if self.size is None:
+        self.size = self.table().total_size()
+      else:
+        self.size += size
+
+      if self.size > self.max_size:
+        self.evict()
+
+  def evict(self):
+    table = self.table()
+    while self.size > self.low_water:
+      oldest = table.get_oldest(100)
+      if not oldest:
+        self.size = 0
+        return
+      for entry in oldest:
+        table.delete(entry)
+        self.size -= entry['size']
+        if self.size <= self.low_water:
+          break
+    logging.info('transaction cache evicted down to %r bytes' % self.size)
@@ -0,0 +1,77 @@
+from shared.db_classes import TableDb, GeneralDb
+
+import os
+
+
+class ObservedUtxo(TableDb):
+  """
+  Outputs paying to observed addresses, as seen by the block scanner.
+  Lets handlers build prevtxs without fetching the funding transaction again.
+  """
+  table_name = "observed_utxo"
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      txid text not null, \
+      n integer not null, \
+      address text not null, \
+      value_satoshi integer not null, \
+      script_pub_key text not null, \
+      height integer, \
+      spent integer default 0, \
+      unique (txid, n));"
+  insert_sql = "insert or ignore into {0} (txid, n, address, value_satoshi, script_pub_key, height) values (?,?,?,?,?,?)"
+  output_sql = "select * from {0} where txid=? and n=?"
+  unspent_sql = "select * from {0} where address=? and spent=0 order by id"
+  spent_sql = "update {0} set spent=1 where txid=? and n=?"
+
+  indexes = ['address']
+
+  def args_for_obj(self, obj):
+    return [obj['txid'], obj['n'], obj['address'], int(obj['value_satoshi']), obj['script_pub_key'], obj['height']]
+
+  def get_output(self, txid, n):
+    cursor = self.db.get_cursor()
+    sql = self.output_sql.format(self.table_name)
+
+    row = cursor.execute(sql, (txid, n)).fetchone()
+    if row:
+      return dict(row)
+    return None
+
+  def get_unspent(self, address):
+    cursor = self.db.get_cursor()
+    sql = self.unspent_sql.format(self.table_name)
+
+    rows = cursor.execute(sql, (address, )).fetchall()
+    return [dict(row) for row in rows]
+
+  def mark_spent_many(self, outputs):
+    """
+    outputs -- (txid, n) pairs, the ones that aren't tracked are ignored
+    """
+    cursor = self.db.get_cursor()
+    sql = self.spent_sql.format(self.table_name)
+    cursor.executemany(sql, list(outputs))
+    self.db.commit()
+
+
+def observed_prevtxs(db_file, address, redeem_script):
+  """
+  (prevtxs, sum in satoshi) of the unspent outputs to address recorded in
+  the oracle database db_file; nothing if there's no such file
+  """
+  if not db_file or not os.path.exists(db_file):
+    return [], 0
+
+  prevtxs = []
+  sum_satoshi = 0
+  for utxo in ObservedUtxo(GeneralDb(db_file)).get_unspent(address):
+    prevtxs.append({
+      'scriptPubKey': utxo['script_pub_key'],
+      'vout': utxo['n'],
+      'txid': utxo['txid'],
+      'redeemScript': redeem_script,
+    })
+    sum_satoshi += utxo['value_satoshi']
+  return prevtxs, sum_satoshi